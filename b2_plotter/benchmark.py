@@ -0,0 +1,372 @@
+'''
+Benchmarks for b2_plotter, and a generator of synthetic Belle II-like MC samples to run them on.
+
+Usage: python3 -m b2_plotter.benchmark startup [--budget seconds] [--module name]
+       python3 -m b2_plotter.benchmark generate -o path/to/MC [-n rows] [-s samples] [--signal-fraction f] [--seed seed]
+       python3 -m b2_plotter.benchmark suite -i path/to/MC [-o results.jsonl] [-r repeat] [--threshold t]
+'''
+
+# Preamble
+import os
+import subprocess
+import sys
+import time
+import json
+import platform
+import tracemalloc
+
+# Time allowed to import the compute-only entry point in a fresh interpreter, on top of EAGER_MODULES, in seconds
+STARTUP_BUDGET = 0.25
+
+# Modules which must not be imported by the compute-only entry point
+HEAVY_MODULES = ['matplotlib', 'uproot']
+
+# Modules which the compute-only entry point imports eagerly, since Plotter takes and checks pandas DataFrames.
+# They are imported before the import is timed, so the budget covers the import of b2_plotter itself.
+EAGER_MODULES = ['numpy', 'pandas']
+
+# Nominal masses of the intermediate particles, in GeV, and the widths of their signal and background peaks
+MASSES = {'xic_M' : (2.4679, 0.004, None), 'xi_M' : (1.32171, 0.003, 0.03), 'lambda_M' : (1.115683, 0.002, 0.02), 
+          'pi0_M' : (0.1349768, 0.006, 0.03)}
+
+# Benchmarks run by the suite, in order
+SUITE = ['construct_dfs', 'plotMC', 'plotData', 'plotFom', 'plotStep', 'getPurity', 'getSigEff']
+
+
+def import_time(module = 'b2_plotter.compute', repeat = 5, preload = EAGER_MODULES):
+
+    '''Measure how long importing a module takes in a fresh Python interpreter.
+
+    :param module: Name of the module to import
+    :type module: str
+    :param repeat: Number of interpreters to start. The fastest import is reported, to reduce noise.
+    :type repeat: int
+    :param preload: Modules imported before the import is timed
+    :type preload: list
+    :return: Fastest import time in seconds, and the heavy modules which the import pulled in
+    :rtype: tuple (float, list)'''
+
+    # The child interpreter times the import itself, so interpreter startup is not counted
+    code = (f'import {", ".join(["sys", "time"] + list(preload))}\n'
+            't = time.perf_counter()\n'
+            f'import {module}\n'
+            'print(time.perf_counter() - t)\n'
+            f'print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))\n')
+
+    # Make sure this copy of b2_plotter is the one imported
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] + 
+                                        ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, env = env, check = True).stdout.split('\n')
+        times.append(float(output[0]))
+        loaded = [name for name in output[1].split(',') if name != '']
+
+    return min(times), loaded
+
+
+def check_startup(budget = STARTUP_BUDGET, module = 'b2_plotter.compute'):
+
+    '''Report the import time of a module and check it against a budget.
+
+    :param budget: Maximum import time in seconds, on top of EAGER_MODULES
+    :type budget: float
+    :param module: Name of the module to import
+    :type module: str
+    :return: Whether the import is within budget and pulled in none of the heavy modules
+    :rtype: bool'''
+
+    seconds, loaded = import_time(module)
+    print(f'import {module}: {seconds * 1000:.0f} ms on top of {", ".join(EAGER_MODULES)} (budget {budget * 1000:.0f} ms)')
+    if len(loaded) > 0:
+        print(f'heavy modules imported at startup: {", ".join(loaded)}')
+
+    return seconds <= budget and len(loaded) == 0
+
+
+def generate(path, nrows = 10**5, signal_fraction = 0.1, peak = (2.4679, 0.004), massrange = (2.2, 2.7), columns = None, 
+             isSigvar = 'xi03pi_xic_isSignal', massvar = 'xi03pi_xic_M', seed = 0, chunk_rows = 10**6, treename = 'xic_tree'):
+
+    '''Write a root file with a tree of synthetic candidates which look like the Xic+ reconstruction: a Gaussian mass 
+    peak on a flat background, and PID, displacement, photon suppression and intermediate mass branches whose 
+    distributions differ between signal and background. The tree is written in chunks, so 10^8 rows fit in memory.
+
+    :param path: Path of the root file to write
+    :type path: str
+    :param nrows: Number of candidates
+    :type nrows: int
+    :param signal_fraction: Fraction of the candidates which are signal
+    :type signal_fraction: float
+    :param peak: Mean and standard deviation of the signal mass peak
+    :type peak: tuple
+    :param massrange: Range of the flat background in the mass
+    :type massrange: tuple
+    :param columns: Branches to write besides isSigvar and massvar (default: Plotter.cols)
+    :type columns: list
+    :param isSigvar: Name of the truth flag branch
+    :type isSigvar: str
+    :param massvar: Name of the mass branch
+    :type massvar: str
+    :param seed: Seed of the random generator
+    :type seed: int
+    :param chunk_rows: Number of candidates generated and written at a time
+    :type chunk_rows: int
+    :param treename: Name of the tree
+    :type treename: str
+    :return: Path of the written file
+    :rtype: str'''
+
+    import numpy
+    import uproot
+    from b2_plotter.Plotter import cols
+
+    columns = [column for column in (cols if columns is None else columns) if column not in (isSigvar, massvar)]
+    rng = numpy.random.default_rng(seed)
+
+    with uproot.recreate(path) as file:
+        for start in range(0, max(nrows, 1), chunk_rows):
+            n = min(chunk_rows, nrows - start)
+            signal = rng.random(n) < signal_fraction
+
+            arrays = {column : _generate_branch(column, signal, rng) for column in columns}
+            arrays[massvar] = numpy.where(signal, rng.normal(peak[0], peak[1], n), rng.uniform(massrange[0], massrange[1], n))
+            arrays[isSigvar] = signal.astype(numpy.float64)
+
+            if start == 0:
+                file[treename] = arrays
+            else:
+                file[treename].extend(arrays)
+
+    return path
+
+
+def generate_samples(outdir, nrows = 10**5, samples = ('ccbar', 'mixed', 'charged', 'uds'), signal_fraction = 0.1, seed = 0, **kwargs):
+
+    '''Write one root file per MC sample in a directory, as read by construct_dfs. The rows are split evenly 
+    between the samples, and every sample is drawn with its own seed. Other arguments are passed to generate.
+
+    :param outdir: Directory to write the files to (created if needed)
+    :type outdir: str
+    :param nrows: Total number of candidates
+    :type nrows: int
+    :param samples: Names of the samples, which become the file names
+    :type samples: tuple
+    :return: Paths of the written files
+    :rtype: list'''
+
+    os.makedirs(outdir, exist_ok = True)
+
+    return [generate(os.path.join(outdir, f'{sample}.root'), nrows // len(samples) + (i < nrows % len(samples)), 
+                     signal_fraction = signal_fraction, seed = seed + i, **kwargs) for i, sample in enumerate(samples)]
+
+
+# Values of one branch for a chunk of candidates, chosen by the kind of variable the name describes
+def _generate_branch(column, signal, rng):
+
+    import numpy
+    n = signal.size
+
+    for suffix, (mass, sigwidth, bkgwidth) in MASSES.items():
+        if column.endswith(suffix) and bkgwidth is not None:
+            return numpy.where(signal, rng.normal(mass, sigwidth, n), rng.normal(mass, bkgwidth, n))
+    if 'protonID' in column:
+        return numpy.where(signal, rng.beta(5, 1, n), rng.beta(1, 2, n))
+    if 'Suppression' in column:
+        return numpy.where(signal, rng.beta(4, 1, n), rng.beta(1.5, 1.5, n))
+    if 'significanceOfDistance' in column:
+        return numpy.where(signal, rng.exponential(8, n), rng.exponential(3, n))
+
+    return rng.normal(signal * 0.5, 1, n)
+
+
+def run_suite(mcpath, repeat = 3, prefix = 'xi03pi_xic', signalregion = (2.46, 2.475), workers = 1):
+
+    '''Time construct_dfs and the Plotter methods on the root files in a directory, e.g. written by 
+    generate_samples. Each benchmark is run repeat times with empty caches and the fastest run is kept, 
+    then once more to trace its peak memory.
+
+    :param mcpath: Directory containing the MC root files
+    :type mcpath: str
+    :param repeat: Number of timed runs of each benchmark
+    :type repeat: int
+    :param prefix: Prefix of Xic+ variables
+    :type prefix: str
+    :param signalregion: Signal region of the mass
+    :type signalregion: tuple
+    :param workers: Number of threads reading the root files in construct_dfs
+    :type workers: int
+    :return: Versions, number of rows and, for each benchmark, seconds, rows per second and peak traced memory in MB
+    :rtype: dict'''
+
+    import numpy
+    import pandas as pd
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from b2_plotter.Plotter import Plotter, construct_dfs, cols
+
+    massvar, var, cuts = f'{prefix}_M', cols[0], f'2.3 < {prefix}_M < 2.65'
+
+    mcdfs = construct_dfs(mcpath, cols, prefix, workers = workers)
+    signaldf = pd.concat(mcdfs.values())
+    plotter = Plotter(isSigvar = f'{prefix}_isSignal', mcdfs = mcdfs, signaldf = signaldf, massvar = massvar, 
+                      signalregion = signalregion, datadf = signaldf)
+    nrows = len(signaldf)
+    colors = ['b', '#ffa500', 'g', 'r', 'c', 'y', '#a52a2a', 'm'] * (len(mcdfs) // 8 + 1)
+
+    benchmarks = {'construct_dfs' : lambda: construct_dfs(mcpath, cols, prefix, workers = workers),
+                  'plotMC' : lambda: plotter.plotMC(massvar, cuts, color = colors[:len(mcdfs) + 1]),
+                  'plotData' : lambda: plotter.plotData(massvar, cuts, color = colors[:len(mcdfs) + 1]),
+                  'plotFom' : lambda: plotter.plotFom(var, cuts),
+                  'plotStep' : lambda: plotter.plotStep(var, cuts),
+                  'getPurity' : lambda: plotter.getPurity(cuts),
+                  'getSigEff' : lambda: plotter.getSigEff(f'{cuts} and {var} > 1')}
+
+    results = {}
+    for name in SUITE:
+        seconds = min(_time_once(benchmarks[name], plotter, plt) for _ in range(repeat))
+
+        tracemalloc.start()
+        _time_once(benchmarks[name], plotter, plt)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[name] = {'seconds' : seconds, 'rows_per_second' : nrows / seconds, 'peak_MB' : peak / 2**20}
+
+    return {'version' : _version(), 'python' : platform.python_version(), 'numpy' : numpy.__version__, 
+            'pandas' : pd.__version__, 'rows' : nrows, 'time' : time.strftime('%Y-%m-%dT%H:%M:%S'), 'benchmarks' : results}
+
+
+# Run a benchmark once with empty caches and return its duration
+def _time_once(benchmark, plotter, plt):
+    plotter.clearCache()
+    start = time.perf_counter()
+    benchmark()
+    seconds = time.perf_counter() - start
+    plt.close('all')
+    return seconds
+
+
+# Version of the source tree, or of the installed package
+def _version():
+    import re
+    import importlib.metadata
+
+    pyproject = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pyproject.toml')
+    if os.path.isfile(pyproject):
+        with open(pyproject) as file:
+            match = re.search(r"^version\s*=\s*['\"](.+)['\"]", file.read(), re.MULTILINE)
+        if match is not None:
+            return match.group(1)
+    try:
+        return importlib.metadata.version('b2_plotter')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def save_results(results, path):
+
+    '''Append suite results to a JSON lines file and compare them to the previous results on the same number of rows.
+
+    :param results: Results returned by run_suite
+    :type results: dict
+    :param path: Path of the JSON lines file
+    :type path: str
+    :return: Previous results on the same number of rows, or None if there are none
+    :rtype: dict or None'''
+
+    previous = None
+    if os.path.isfile(path):
+        with open(path) as file:
+            for line in file:
+                record = json.loads(line)
+                if record['rows'] == results['rows']:
+                    previous = record
+
+    with open(path, 'a') as file:
+        file.write(json.dumps(results) + '\n')
+
+    return previous
+
+
+def compare(previous, results, threshold = 0.2):
+
+    '''Find the benchmarks which got slower, or use more memory, than in previous results.
+
+    :param previous: Earlier results of run_suite
+    :type previous: dict
+    :param results: Current results of run_suite
+    :type results: dict
+    :param threshold: Relative increase counted as a regression
+    :type threshold: float
+    :return: Description of each regression
+    :rtype: list'''
+
+    regressions = []
+    for name, current in results['benchmarks'].items():
+        if name not in previous['benchmarks']:
+            continue
+        before = previous['benchmarks'][name]
+        for metric in ('seconds', 'peak_MB'):
+            if current[metric] > before[metric] * (1 + threshold):
+                regressions.append(f'{name}: {metric} {before[metric]:.3g} -> {current[metric]:.3g} '
+                                   f'(version {previous["version"]} -> {results["version"]})')
+
+    return regressions
+
+
+def main():
+
+    import argparse
+
+    # Create an argument parser with one subcommand per benchmark
+    parser = argparse.ArgumentParser(usage = 'python3 -m b2_plotter.benchmark startup [--budget seconds] [--module name]')
+    subparsers = parser.add_subparsers(dest = 'benchmark', required = True)
+
+    startup = subparsers.add_parser('startup', help = 'Measure the import time of the compute-only entry point')
+    startup.add_argument('--budget', help = 'Maximum import time in seconds, on top of numpy and pandas', type = float, default = STARTUP_BUDGET)
+    startup.add_argument('--module', help = 'Module to import', type = str, default = 'b2_plotter.compute')
+
+    generator = subparsers.add_parser('generate', help = 'Write synthetic MC root files')
+    generator.add_argument('-o', '--output', help = 'Directory to write the root files to', type = str, required = True)
+    generator.add_argument('-n', '--rows', help = 'Total number of candidates', type = float, default = 1e5)
+    generator.add_argument('-s', '--samples', help = 'Number of MC samples', type = int, default = 4)
+    generator.add_argument('--signal-fraction', help = 'Fraction of signal candidates', type = float, default = 0.1)
+    generator.add_argument('--seed', help = 'Seed of the random generator', type = int, default = 0)
+
+    suite = subparsers.add_parser('suite', help = 'Time construct_dfs and the Plotter methods')
+    suite.add_argument('-i', '--input', help = 'Directory containing the MC root files', type = str, required = True)
+    suite.add_argument('-o', '--output', help = 'JSON lines file the results are appended to', type = str, default = 'benchmarks.jsonl')
+    suite.add_argument('-r', '--repeat', help = 'Number of timed runs of each benchmark', type = int, default = 3)
+    suite.add_argument('-j', '--workers', help = 'Number of threads reading the root files', type = int, default = 1)
+    suite.add_argument('--threshold', help = 'Relative slowdown counted as a regression', type = float, default = 0.2)
+
+    args = parser.parse_args()
+
+    # Exit with a non-zero status if the benchmark fails, so it can gate CI jobs
+    if args.benchmark == 'startup':
+        sys.exit(0 if check_startup(args.budget, args.module) else 1)
+
+    if args.benchmark == 'generate':
+        samples = ('ccbar', 'mixed', 'charged', 'uds', 'taupair', 'ddbar', 'ssbar', 'bbbar')[:args.samples] if args.samples <= 8 \
+                  else tuple(f'sample{i}' for i in range(args.samples))
+        for path in generate_samples(args.output, int(args.rows), samples, args.signal_fraction, args.seed):
+            print(path)
+
+    if args.benchmark == 'suite':
+        results = run_suite(args.input, args.repeat, workers = args.workers)
+        print(f'{results["rows"]} rows, b2_plotter {results["version"]}')
+        for name, result in results['benchmarks'].items():
+            print(f'{name:15} {result["seconds"] * 1000:10.1f} ms {result["rows_per_second"] / 1e6:10.2f} Mrows/s {result["peak_MB"]:10.1f} MB')
+
+        previous = save_results(results, args.output)
+        regressions = compare(previous, results, args.threshold) if previous is not None else []
+        for regression in regressions:
+            print(f'regression: {regression}')
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
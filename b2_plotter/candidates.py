@@ -0,0 +1,211 @@
+'''
+Best candidate selection of b2_plotter. BestCandidate keeps one candidate per event: the one with the highest 
+(or lowest) value of a ranking column, found by sorting the packed event keys once instead of with groupby.
+'''
+
+# Preamble
+import numpy
+import pandas as pd
+from b2_plotter.helpers import _stage
+
+
+# Columns identifying an event in Belle II ntuples, which BestCandidate keeps one candidate of by default
+EVENT_KEYS = ['__experiment__', '__run__', '__event__', '__production__']
+
+
+class BestCandidate():
+
+    def __init__(self, rank: str, keys: list = None, highest: bool = True):
+
+        '''
+        Best candidate selection, keeping one candidate (row) per event, or per value of other key columns: the 
+        one with the highest (or lowest) value of a ranking column. Ties go to the first of the tied candidates, 
+        and candidates with a nan rank are only kept if every candidate of their event has one. The candidates 
+        are sorted by key once (the keys packed into a single integer when they fit), and the best rank of each 
+        key and the first row having it are found with reductions over the sorted runs, so there is no groupby.
+        Given to construct_dfs, the selection runs on each chunk of a streamed tree as it is read, keeping only
+        the best candidate of each key of the chunk, and once more on those at the end.
+
+        Selected frames get a column __multiplicity__ with the number of candidates of the event of each kept 
+        candidate, which is summed when an already selected frame is selected again, and the multiplicity of 
+        every selected sample is recorded for report().
+
+        :param rank: Name of the ranking column
+        :type rank: str
+        :param keys: Names of the columns identifying an event (default is EVENT_KEYS). Names which are not 
+                     columns of the frame are ignored, but at least one of them must be.
+        :type keys: list
+        :param highest: Keep the candidate with the highest rank, or with the lowest
+        :type highest: bool
+
+        :raise TypeError: If rank is not a str or keys is not a list of str
+        '''
+
+        if isinstance(rank, str):
+            self.rank = rank
+        else:
+            raise TypeError('rank is not a string.')
+
+        if keys is None:
+            keys = EVENT_KEYS
+        if isinstance(keys, (list, tuple)) and all(isinstance(key, str) for key in keys):
+            self.keys = list(keys)
+        else:
+            raise TypeError('keys is not a list of strings.')
+
+        self.highest = highest
+        self.countcol = '__multiplicity__'
+
+        # label : number of events with each number of candidates, of the samples selected so far
+        self.multiplicities = {}
+
+    @property
+    def branches(self):
+
+        '''Columns the selection needs: the keys and the ranking column.'''
+
+        return self.keys + [self.rank]
+
+    def select(self, df, label = None):
+
+        '''Keep the best candidate of each event of a dataframe.
+
+        :param df: The candidates
+        :type df: pandas DataFrame
+        :param label: If given, record the multiplicity of the frame under this label for report()
+        :type label: str
+        :return: The best candidates, in the order of df, with their __multiplicity__
+        :rtype: pandas DataFrame
+
+        :raise ValueError: If none of the keys, or the ranking column, is a column of df
+        '''
+
+        with _stage('best_candidate', len(df)) as stage:
+            arrays = {column : df[column].to_numpy() for column in self.branches + [self.countcol] if column in df.columns}
+            rows, multiplicity = self._best(arrays)
+            selected = df.iloc[rows].reset_index(drop = True)
+            selected[self.countcol] = multiplicity
+            stage.rows_out = len(selected)
+
+        if label is not None:
+            self._record(label, multiplicity)
+
+        return selected
+
+    def report(self):
+
+        '''Candidate multiplicity of every sample selected so far.
+
+        :return: Number of events, number of candidates, mean and maximum number of candidates per event, and 
+                 percentage of events with more than one candidate, of each label
+        :rtype: pandas DataFrame'''
+
+        rows = {}
+        for label, events in self.multiplicities.items():
+            multiplicity = numpy.arange(len(events))
+            nevents = events.sum()
+            rows[label] = {'events' : nevents, 'candidates' : (multiplicity * events).sum(), 
+                           'mean' : (multiplicity * events).sum() / nevents if nevents > 0 else numpy.nan, 
+                           'max' : len(events) - 1 if nevents > 0 else 0, 
+                           'multiple' : events[2:].sum() / nevents * 100 if nevents > 0 else numpy.nan}
+
+        return pd.DataFrame.from_dict(rows, orient = 'index', columns = ['events', 'candidates', 'mean', 'max', 'multiple'])
+
+    def _reduce(self, chunks):
+
+        # Keep the best candidates of each chunk of arrays, and then the best of those, so only one row per 
+        # event and chunk is held in memory. Returns the arrays of the best candidates, with their multiplicity.
+        kept = []
+        for chunk in chunks:
+            with _stage('best_candidate', len(next(iter(chunk.values()), []))) as stage:
+                rows, multiplicity = self._best(chunk)
+                kept.append(dict({column : values[rows] for column, values in chunk.items() if column != self.countcol}, 
+                                 **{self.countcol : multiplicity}))
+                stage.rows_out = len(rows)
+
+        if len(kept) == 0:
+            return None
+        arrays = {column : numpy.concatenate([chunk[column] for chunk in kept]) for column in kept[0]}
+        if len(kept) == 1:
+            return arrays
+
+        rows, multiplicity = self._best(arrays)
+        return dict({column : values[rows] for column, values in arrays.items() if column != self.countcol}, 
+                    **{self.countcol : multiplicity})
+
+    def _best(self, arrays):
+
+        # Rows of the best candidate of each key, in their original order, and the number of candidates of each key
+        keys = [arrays[key] for key in self.keys if key in arrays]
+        if len(keys) == 0 or self.rank not in arrays:
+            raise ValueError(f'The best candidate selection needs the ranking column {self.rank} and one of the keys {self.keys}.')
+
+        rank = arrays[self.rank]
+        counts = arrays.get(self.countcol)
+        if len(rank) == 0:
+            return numpy.empty(0, dtype = numpy.intp), numpy.empty(0, dtype = numpy.int32 if counts is None else counts.dtype)
+
+        # Sort the rows by key once, and find where each key starts
+        key = _pack_keys(keys)
+        if key is not None:
+            order = numpy.argsort(key)
+            sortedkeys = [key[order]]
+        else:
+            order = numpy.lexsort(keys[::-1])
+            sortedkeys = [key[order] for key in keys]
+        boundaries = numpy.zeros(len(order), dtype = bool)
+        boundaries[0] = True
+        for sortedkey in sortedkeys:
+            boundaries[1:] |= sortedkey[1:] != sortedkey[:-1]
+        starts = numpy.flatnonzero(boundaries)
+
+        # Best rank of each key, ignoring nan unless all of its ranks are, and the first row having it
+        ranks = rank[order]
+        best = (numpy.fmax if self.highest else numpy.fmin).reduceat(ranks, starts)
+        groups = numpy.cumsum(boundaries) - 1
+        hits = ranks == best[groups]
+        if ranks.dtype.kind == 'f':
+            hits |= numpy.isnan(best)[groups]
+        rows = numpy.minimum.reduceat(numpy.where(hits, order, len(order)), starts)
+
+        multiplicity = (numpy.add.reduceat(counts[order], starts, dtype = counts.dtype) if counts is not None 
+                        else numpy.diff(numpy.append(starts, len(order))).astype(numpy.int32))
+
+        # Back to the original order of the rows, by marking them instead of sorting
+        kept = numpy.zeros(len(order), dtype = bool)
+        kept[rows] = True
+        multiplicities = numpy.empty(len(order), dtype = multiplicity.dtype)
+        multiplicities[rows] = multiplicity
+        rows = numpy.flatnonzero(kept)
+        return rows, multiplicities[rows]
+
+    def _record(self, label, multiplicity):
+        self.multiplicities[label] = numpy.bincount(multiplicity.astype(numpy.intp, copy = False), minlength = 2)
+
+
+# Pack integer key columns into one uint64 whose values are equal exactly when all of the keys are, or None if 
+# they are not integers or their ranges need more than 64 bits
+def _pack_keys(keys):
+
+    if len(keys) == 1:
+        return keys[0]
+    if any(key.dtype.kind not in 'biu' for key in keys):
+        return None
+
+    packed, bits = numpy.zeros(len(keys[0]), dtype = numpy.uint64), 0
+    for key in keys:
+        low = int(key.min())
+        width = (int(key.max()) - low).bit_length()
+        if width == 0:
+            continue
+        if bits + width > 64:
+            return None
+
+        # key - low wraps around in uint64 like it would in int64, and is never negative
+        shifted = key.astype(numpy.uint64)
+        shifted -= numpy.uint64(low % 2**64)
+        shifted <<= numpy.uint64(bits)
+        packed |= shifted
+        bits += width
+
+    return packed
@@ -0,0 +1,12 @@
+'''
+Compute-only entry point of b2_plotter, for batch jobs which only need numbers (histograms, FOM scans, 
+purities and efficiencies). Importing it never imports matplotlib or uproot; they are only loaded if a 
+plotting function is called or a root file is opened.
+'''
+
+from b2_plotter.Plotter import Plotter, HistResult, construct_dfs, set_backend
+from b2_plotter.cuts import CutCache, split_cuts
+from b2_plotter.incremental import IncrementalScan
+from b2_plotter.stats import ColumnStats
+from b2_plotter.store import ColumnCache, ColumnStore
+from b2_plotter.candidates import BestCandidate
@@ -0,0 +1,150 @@
+'''
+Cut evaluation of b2_plotter. split_cuts splits a cut into its top-level "and" clauses, and CutCache evaluates 
+each clause once per DataFrame, skipping the chunks of rows which ColumnStats decides, and ANDs the cached masks.
+'''
+
+# Preamble
+import re
+import weakref
+import numpy
+from collections import OrderedDict
+from b2_plotter.stats import ColumnStats
+
+
+class CutCache():
+
+    def __init__(self, maxbytes: int = 2**30, chunkRows: int = 2**16):
+
+        '''
+        Cache of boolean masks for cut expressions. A cut is split into its top-level "and" clauses, 
+        each clause is evaluated once per DataFrame with DataFrame.eval, and compound cuts are built 
+        by ANDing the cached clause masks. Masks are keyed by the expression and the identity of the 
+        DataFrame, evicted in least-recently-used order once maxbytes is exceeded, and dropped when 
+        the DataFrame is garbage collected. Clauses comparing a column to numbers are only evaluated 
+        on the chunks of rows which the column statistics in self.stats cannot decide.
+
+        :param maxbytes: Memory budget for all cached masks, in bytes
+        :type maxbytes: int
+        :param chunkRows: Number of rows in each chunk of the column statistics
+        :type chunkRows: int
+
+        :raise TypeError: If maxbytes is not an int
+        '''
+
+        if isinstance(maxbytes, int):
+            self.maxbytes = maxbytes
+        else:
+            raise TypeError('maxbytes is not an int.')
+
+        # Per-chunk statistics of the columns, for predicate pushdown and dynamic ranges
+        self.stats = ColumnStats(chunkRows)
+
+        # (id(df), len(df), expression) : mask, ordered from least to most recently used
+        self.masks = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+
+        # id(df) : finalizer which forgets the masks of df once it is garbage collected
+        self._finalizers = {}
+
+    def mask(self, df, *cuts):
+
+        '''Return the boolean mask of the rows of df passing all of the cuts.
+
+        :param df: Dataframe the cuts are applied to
+        :type df: pandas DataFrame
+        :param cuts: Cut expressions in DataFrame.query syntax, ANDed together. Empty strings are ignored.
+        :type cuts: str
+        :return: Mask with one entry per row of df
+        :rtype: numpy array of bool'''
+
+        # Split every cut into its clauses, dropping duplicates but keeping the order
+        clauses = []
+        for cut in cuts:
+            for clause in split_cuts(cut):
+                if clause not in clauses:
+                    clauses.append(clause)
+
+        # Look up the full expression first, then build it out of the clause masks
+        expression = ' and '.join(clauses)
+        mask = self._lookup(df, expression)
+        if mask is None:
+            if len(clauses) == 0:
+                mask = numpy.ones(len(df), dtype = bool)
+            elif len(clauses) == 1:
+                mask = self.stats.mask(df, expression)
+            else:
+                mask = self.mask(df, clauses[0]).copy()
+                for clause in clauses[1:]:
+                    mask &= self.mask(df, clause)
+            self._store(df, expression, mask)
+
+        return mask
+
+    def clear(self):
+
+        '''Remove every cached mask and column statistics.'''
+
+        self.masks.clear()
+        self.nbytes = 0
+        self.stats.clear()
+
+    def _lookup(self, df, expression):
+
+        key = (id(df), len(df), expression)
+        if key in self.masks:
+            self.hits += 1
+            self.masks.move_to_end(key)
+            return self.masks[key]
+        self.misses += 1
+        return None
+
+    def _store(self, df, expression, mask):
+
+        # Masks bigger than the whole budget are never cached
+        if mask.nbytes > self.maxbytes:
+            return
+
+        # Evict the least recently used masks until the new one fits
+        while self.nbytes + mask.nbytes > self.maxbytes:
+            _, old = self.masks.popitem(last = False)
+            self.nbytes -= old.nbytes
+
+        self.masks[(id(df), len(df), expression)] = mask
+        self.nbytes += mask.nbytes
+
+        # Forget the masks of df when it is deleted, so a new frame reusing its id never sees them
+        if id(df) not in self._finalizers:
+            self._finalizers[id(df)] = weakref.finalize(df, self._forget, id(df))
+
+    def _forget(self, dfid):
+
+        for key in [key for key in self.masks if key[0] == dfid]:
+            self.nbytes -= self.masks.pop(key).nbytes
+        self._finalizers.pop(dfid, None)
+
+
+# Split a cut expression into its top-level "and" clauses
+def split_cuts(cuts):
+
+    '''Split a cut expression into the clauses which are ANDed together at the top level, 
+    i.e. outside of any parentheses. "a < 1 and (b > 2 or c > 3)" gives ["a < 1", "(b > 2 or c > 3)"].
+
+    :param cuts: Cut expression in DataFrame.query syntax
+    :type cuts: str
+    :return: Clauses, stripped of surrounding whitespace
+    :rtype: list of str'''
+
+    clauses, depth, start = [], 0, 0
+    for match in re.finditer(r'[()]|\band\b', cuts):
+        token = match.group()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth == 0:
+            clauses.append(cuts[start:match.start()])
+            start = match.end()
+    clauses.append(cuts[start:])
+
+    return [clause.strip() for clause in clauses if clause.strip() != '']
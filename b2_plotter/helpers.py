@@ -0,0 +1,409 @@
+'''
+Shared helpers of the b2_plotter modules: lazy imports of matplotlib and uproot, the per-stage profiler, reading 
+root files, and the counting kernels and FOM curves behind the scans. It imports no other module of b2_plotter, 
+so every module can import it.
+'''
+
+# Preamble
+import numpy
+import pandas as pd
+import importlib
+import os
+import json
+import numbers
+import time
+import threading
+import functools
+import contextlib
+import tracemalloc
+from collections import OrderedDict
+
+
+class _LazyModule():
+
+    # Stand-in for a module which is only imported the first time one of its attributes is used, so that 
+    # importing b2_plotter stays cheap for jobs which never draw a plot or open a root file
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+plt = _LazyModule('matplotlib.pyplot')
+up = _LazyModule('uproot')
+
+
+class Profile():
+
+    def __init__(self, traceMemory: bool = True):
+
+        '''
+        Statistics of the stages run while a profiling() block is active: reading root files, concatenating 
+        frames, evaluating cuts, histogramming, scanning FOMs, drawing and saving plots, and the Plotter methods 
+        and construct_dfs calls they happen in. Stages are keyed by their path, e.g. "plotMC/histMC/cuts", and 
+        each records its number of calls, wall time in seconds, rows in and out (where they apply) and the peak 
+        number of bytes allocated above the memory in use when it started. Stages run on worker threads (the file 
+        reads of construct_dfs with workers > 1) are recorded at the top level, with their seconds added up over 
+        the threads, and their memory is only approximate since tracemalloc counts the allocations of all threads.
+
+        :param traceMemory: Trace allocations with tracemalloc, which slows down Python code
+        :type traceMemory: bool
+        '''
+
+        self.traceMemory = traceMemory
+
+        # path : {'calls', 'seconds', 'rows_in', 'rows_out', 'bytes'}, in the order the stages were first run
+        self.stats = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def summary(self):
+
+        '''Return the statistics as a table, one line per stage path.'''
+
+        lines = [f'{"stage":50} {"calls":>6} {"seconds":>9} {"rows in":>11} {"rows out":>11} {"MB":>9}']
+        for path, stat in self.stats.items():
+            rows = [f'{stat[key]:11d}' if stat[key] is not None else f'{"":11}' for key in ('rows_in', 'rows_out')]
+            mb = f'{stat["bytes"] / 2**20:9.1f}' if stat['bytes'] is not None else f'{"":9}'
+            lines.append(f'{path:50} {stat["calls"]:6d} {stat["seconds"]:9.3f} {rows[0]} {rows[1]} {mb}')
+        return '\n'.join(lines)
+
+    def save(self, path):
+
+        '''Write the statistics to a JSON file.'''
+
+        with open(path, 'w') as file:
+            json.dump(self.stats, file, indent = 1)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, path, seconds, rows_in, rows_out, nbytes):
+        with self._lock:
+            stat = self.stats.setdefault(path, {'calls' : 0, 'seconds' : 0.0, 'rows_in' : None, 'rows_out' : None, 'bytes' : None})
+            stat['calls'] += 1
+            stat['seconds'] += seconds
+            for key, value in (('rows_in', rows_in), ('rows_out', rows_out)):
+                if value is not None:
+                    stat[key] = (stat[key] or 0) + int(value)
+            if nbytes is not None:
+                stat['bytes'] = max(stat['bytes'] or 0, nbytes)
+
+
+# Profile recording the stages, while a profiling() block is active
+_profile = None
+
+
+@contextlib.contextmanager
+def profiling(traceMemory = True):
+
+    '''Context manager recording per-stage statistics of everything run inside it. Outside of it, the 
+    instrumentation costs one check per stage.
+
+    :param traceMemory: Trace allocations with tracemalloc, which slows down Python code
+    :type traceMemory: bool
+    :return: The statistics, filled in as the block runs
+    :rtype: Profile'''
+
+    global _profile
+    outer, _profile = _profile, Profile(traceMemory)
+    tracing = traceMemory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        yield _profile
+    finally:
+        if tracing:
+            tracemalloc.stop()
+        _profile = outer
+
+
+class _Stage():
+
+    # One running stage of the active profile. rows_out can be set while it runs.
+    def __init__(self, profile, name, rows_in):
+        self.profile, self.name, self.rows_in, self.rows_out = profile, name, rows_in, None
+
+    def __enter__(self):
+        stack = self.profile._stack()
+        self.path = f'{stack[-1].path}/{self.name}' if len(stack) > 0 else self.name
+        self.peak = None
+        if self.profile.traceMemory and tracemalloc.is_tracing():
+            # Every open stage keeps the highest peak seen below it, since the peak is reset for each stage
+            self.start, self.peak = tracemalloc.get_traced_memory()[0], 0
+            if len(stack) > 0 and stack[-1].peak is not None:
+                stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.time
+        stack = self.profile._stack()
+        stack.pop()
+        nbytes = None
+        if self.peak is not None:
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            nbytes = max(0, peak - self.start)
+            if len(stack) > 0 and stack[-1].peak is not None:
+                stack[-1].peak = max(stack[-1].peak, peak)
+        self.profile._record(self.path, seconds, self.rows_in, self.rows_out, nbytes)
+        return False
+
+
+class _NoStage():
+
+    # Stand-in for a stage when profiling is off, ignoring rows_out
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_nostage = _NoStage()
+
+
+# Context manager timing a stage of the active profile, or doing nothing when profiling is off
+def _stage(name, rows_in = None):
+    return _nostage if _profile is None else _Stage(_profile, name, rows_in)
+
+
+# Decorator recording every call of a function as a stage named after it
+def _profiled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _profile is None:
+            return function(*args, **kwargs)
+        with _Stage(_profile, function.__name__, None):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+# Size and modification time of a file, which change whenever the file is rewritten
+def _file_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Weights of the rows of df selected by mask: a number, or an array from a column of per-event weights
+def _file_weights(df, mask, weight):
+    if isinstance(weight, str):
+        return df[weight].to_numpy()[mask]
+    if isinstance(weight, numbers.Number):
+        return weight
+    raise TypeError('scale and bgscale must be numbers or column names.')
+
+
+# Read the branches of the xic_tree in a root file into a dataframe, keeping only the best candidates if a 
+# BestCandidate is given
+def _load_tree(path, branches, step_size = None, executor = None, treename = 'xic_tree', best = None):
+
+    # Decompress and interpret baskets on the executor if one is given
+    options = {} if executor is None else {'decompression_executor' : executor, 'interpretation_executor' : executor}
+
+    with up.open(path) as file:
+        tree = file[treename]
+
+        if step_size is None:
+            arrays = tree.arrays(filter_name = branches, library = 'np', **options)
+            if best is not None:
+                arrays = best._reduce([arrays])
+        elif best is not None:
+            # Stream the tree in chunks, keeping only the best candidates of each one as it is read
+            arrays = best._reduce(tree.iterate(filter_name = branches, step_size = step_size, library = 'np', **options))
+        else:
+            # Stream the tree in chunks and join the columns once at the end
+            chunks = list(tree.iterate(filter_name = branches, step_size = step_size, library = 'np', **options))
+            arrays = {branch : numpy.concatenate([chunk[branch] for chunk in chunks]) for branch in chunks[0]} if len(chunks) > 0 \
+                     else None
+
+        if arrays is None:
+            arrays = tree.arrays(filter_name = branches, library = 'np', entry_stop = 0)
+            if best is not None:
+                arrays[best.countcol] = numpy.empty(0, dtype = numpy.int32)
+
+    return pd.DataFrame(arrays, copy = False)
+
+
+# Sum of the weights of n values, where the weight is a number or an array of per-value weights
+def _sum_weights(n, weight):
+    return numpy.sum(weight) if isinstance(weight, numpy.ndarray) else n * weight
+
+
+# Test cuts of a FOM scan: nbins evenly spaced values starting at the lower end of the range, which is 
+# derived from the selected signal values if not given
+def _test_cuts(np_sig, myrange, isGreaterThan, nbins):
+
+    if myrange == () and isGreaterThan:
+        # Calculate the dynamic range for the variable based on the data within the specified cuts
+        myrange = (numpy.min(np_sig), numpy.max(np_sig))
+    elif myrange == () and not isGreaterThan:
+        myrange = (numpy.min(np_sig) + (numpy.max(np_sig) / 10), numpy.max(np_sig))
+
+    # Define some interval to iterate over based on the range and the number of bins, and 
+    # define each test cut as (interval * bin) + x_min
+    interval = (myrange[1] - myrange[0]) / nbins
+    return numpy.array([interval * bin + myrange[0] for bin in range(0, nbins)])
+
+
+# Statistical uncertainty of FOM = S / sqrt(S + B), propagated from the sums of squared weights of S and B
+def _fom_error(sig, bkg, sigsumw2, bkgsumw2):
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        total = (sig + bkg)**1.5
+        return numpy.sqrt(((sig + 2 * bkg) / (2 * total))**2 * sigsumw2 + (sig / (2 * total))**2 * bkgsumw2)
+
+
+# FOM, signal efficiency and purity curves of a scan from the (weighted) number of signal events in the signal 
+# region and the numbers of signal and background events passing each test cut, with their sums of squared weights
+def _fom_curves(testcuts, total_sig, globalsig, globalbkg, sigsumw2, bkgsumw2):
+
+    nbins = len(testcuts)
+
+    # Calculate the figure of merit, signal efficiency and purity for each bin. Empty bins give nan, as before.
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        fom = globalsig / numpy.sqrt(globalsig + globalbkg)
+        sigeff = globalsig / total_sig
+        purity = globalsig / (globalbkg + globalsig)
+        fomerr = _fom_error(globalsig, globalbkg, sigsumw2, bkgsumw2)
+
+    # Repeat the signal efficiency and purity of the second to last bin in the final bin so the curves flatten out.
+    sigeff[nbins - 1] = sigeff[nbins - 2]
+    purity[nbins - 1] = purity[nbins - 2]
+
+    return {'testcuts' : testcuts, 'globalsig' : globalsig, 'globalbkg' : globalbkg,
+            'fom' : fom, 'sigeff' : sigeff, 'purity' : purity, 'sigsumw2' : sigsumw2, 'bkgsumw2' : bkgsumw2, 
+            'fomerr' : fomerr}
+
+
+# Rows of a scanFoms table for the scan of one variable and direction
+def _fom_table(var, isGreaterThan, scan):
+
+    # Flag the test cut at the maximum of the FOM curve, ignoring the nan of empty test cuts
+    optimal = numpy.zeros(len(scan['testcuts']), dtype = bool)
+    optimal[numpy.argmax(numpy.where(numpy.isnan(scan['fom']), -numpy.inf, scan['fom']))] = True
+
+    return pd.DataFrame({'variable' : var, 'isGreaterThan' : isGreaterThan, 
+                         'testcut' : scan['testcuts'], 'globalsig' : scan['globalsig'], 
+                         'globalbkg' : scan['globalbkg'], 'fom' : scan['fom'], 
+                         'sigeff' : scan['sigeff'], 'purity' : scan['purity'], 
+                         'sigsumw2' : scan['sigsumw2'], 'bkgsumw2' : scan['bkgsumw2'], 
+                         'fomerr' : scan['fomerr'], 'optimal' : optimal})
+
+
+# Count the values passing var > testcut (or var < testcut) weighted by a number, applied after counting, 
+# or by an array of per-value weights. Returns the weighted counts and the sums of squared weights.
+def _count_passing_weighted(values, testcuts, isGreaterThan, weight):
+    if isinstance(weight, numpy.ndarray):
+        return (_count_passing(values, testcuts, isGreaterThan, weight), 
+                _count_passing(values, testcuts, isGreaterThan, weight**2))
+    counts = _count_passing(values, testcuts, isGreaterThan)
+    return counts * weight, counts * weight**2
+
+
+# Count the values passing var > testcut (or var < testcut) for every testcut in one pass
+def _count_passing(values, testcuts, isGreaterThan, weights = None):
+
+    # Rows where var is nan never pass a comparison in DataFrame.query, so drop them
+    keep = ~numpy.isnan(values)
+    values = values[keep]
+    if weights is not None:
+        weights = weights[keep]
+
+    # The test cuts are not necessarily ascending (the automatic range for var < testcut is reversed for narrow 
+    # peaks), so bin in sorted order and map the counts back to the order of the test cuts
+    order = numpy.argsort(testcuts, kind = 'stable')
+
+    # Histogram the values in the bins delimited by the sorted test cuts. For var > testcut the bin index is 
+    # the number of test cuts strictly below the value, for var < testcut it is the number at or below it, 
+    # so the strict inequalities of the original query are reproduced exactly.
+    side = 'left' if isGreaterThan else 'right'
+    indices = numpy.searchsorted(testcuts[order], values, side = side)
+    hist = numpy.bincount(indices, weights = weights, minlength = testcuts.size + 1)
+
+    # var > testcut[i] for every value in a bin above i, var < testcut[i] for every value in a bin at or below i
+    counts = numpy.empty(testcuts.size, dtype = hist.dtype)
+    if isGreaterThan:
+        counts[order] = numpy.cumsum(hist[::-1])[::-1][1:]
+    else:
+        counts[order] = numpy.cumsum(hist)[:-1]
+    return counts
+
+
+# Same as _count_passing_weighted for combinations of test cuts on several variables
+def _count_passing_grid_weighted(values, testcuts, directions, weight):
+    if isinstance(weight, numpy.ndarray):
+        return (_count_passing_grid(values, testcuts, directions, weight), 
+                _count_passing_grid(values, testcuts, directions, weight**2))
+    counts = _count_passing_grid(values, testcuts, directions)
+    return counts * weight, counts * weight**2
+
+
+# Count the rows passing every combination of test cuts on several variables in one pass, as an array with 
+# one axis per variable. values holds one array per variable, with the same rows.
+def _count_passing_grid(values, testcuts, directions, weights = None):
+
+    # Rows where any of the variables is nan never pass a comparison in DataFrame.query, so drop them
+    keep = numpy.logical_and.reduce([~numpy.isnan(column) for column in values])
+    if weights is not None:
+        weights = weights[keep]
+
+    # Histogram the rows in the N-D bins delimited by the sorted test cuts, using the same bin indices as _count_passing
+    orders = [numpy.argsort(cuts, kind = 'stable') for cuts in testcuts]
+    indices = [numpy.searchsorted(cuts[order], column[keep], side = 'left' if isGreaterThan else 'right') 
+               for column, cuts, order, isGreaterThan in zip(values, testcuts, orders, directions)]
+    shape = tuple(cuts.size + 1 for cuts in testcuts)
+    hist = numpy.bincount(numpy.ravel_multi_index(indices, shape), weights = weights, 
+                          minlength = int(numpy.prod(shape))).reshape(shape)
+
+    # Cumulative sum along each axis in the direction of its cut, as in _count_passing
+    for axis, isGreaterThan in enumerate(directions):
+        if isGreaterThan:
+            hist = numpy.flip(numpy.cumsum(numpy.flip(hist, axis), axis = axis), axis)
+            hist = numpy.take(hist, numpy.arange(1, shape[axis]), axis = axis)
+        else:
+            hist = numpy.take(numpy.cumsum(hist, axis = axis), numpy.arange(shape[axis] - 1), axis = axis)
+
+        # Back to the order of the test cuts along this axis
+        hist = numpy.take(hist, numpy.argsort(orders[axis], kind = 'stable'), axis = axis)
+
+    return hist
+
+
+# Count the values inside every window testcuts[i] < var < testcuts[j] in one pass, weighted by a number or by an 
+# array of per-value weights, as arrays indexed by (i, j). Returns the weighted counts and the sums of squared weights.
+def _count_window(values, testcuts, weight):
+    if isinstance(weight, numpy.ndarray):
+        return _count_window_sums(values, testcuts, weight), _count_window_sums(values, testcuts, weight**2)
+    counts = _count_window_sums(values, testcuts)
+    return counts * weight, counts * weight**2
+
+
+def _count_window_sums(values, testcuts, weights = None):
+
+    # Rows where var is nan never pass a comparison in DataFrame.query, so drop them
+    keep = ~numpy.isnan(values)
+    values = values[keep]
+    if weights is not None:
+        weights = weights[keep]
+
+    # A value with k test cuts strictly below it is inside testcuts[i] < var < testcuts[j] for every i < k, and every 
+    # j >= k unless it is equal to testcuts[k], then only j > k. Histogram the values between test cuts and on them 
+    # separately; each window is then a difference of their (monotone, so never negative) prefix sums.
+    n = testcuts.size
+    indices = numpy.searchsorted(testcuts, values, side = 'left')
+    onedge = numpy.zeros(values.size, dtype = bool)
+    onedge[indices < n] = values[indices < n] == testcuts[indices[indices < n]]
+    between = numpy.cumsum(numpy.bincount(indices[~onedge], weights = None if weights is None else weights[~onedge], minlength = n + 1))
+    on = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(indices[onedge], weights = None if weights is None else weights[onedge], minlength = n))])
+
+    return (between[None, :n] - between[:n, None]) + (on[None, :n] - on[1:, None])
@@ -0,0 +1,226 @@
+'''
+Incremental FOM scans of b2_plotter, for MC directories which grow over time. IncrementalScan keeps the numbers 
+of signal and background events passing every test cut of each root file in a state directory, so an update only 
+reads the files which were added or changed since the last one, and the scans are computed from the sums.
+'''
+
+# Preamble
+import os
+import json
+import hashlib
+import numpy
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from b2_plotter.helpers import (_stage, _load_tree, _file_stat, _file_weights, _sum_weights, _test_cuts,
+                                _count_passing_weighted, _fom_curves, _fom_table)
+from b2_plotter.cuts import CutCache
+
+
+class IncrementalScan():
+
+    def __init__(self, statedir: str, vars: list, cuts: str, isSigvar: str, massvar: str, signalregion: tuple, 
+                 branches: list = None, directions: tuple = (True, False), myrange: dict = {}, nbins: int = 100, 
+                 scale = 1, bgscale = 1, treename: str = 'xic_tree', step_size = None):
+
+        '''
+        FOM scans of several variables (as Plotter.scanFoms gives for a Plotter whose signal is every MC file 
+        and whose background samples are the individual files) kept up to date as MC files are added to, 
+        changed in or removed from a directory. For each file, the numbers of signal and background events 
+        passing every test cut are stored in statedir, and the scans are computed from their sums, so an update 
+        only reads the new and changed files, and removed files are simply left out of the sums.
+
+        The test cuts must stay fixed for the per-file counts to add up. Ranges missing from myrange are derived 
+        from the files present at the first update, as scanFoms would, and then kept; they are derived again 
+        (and every file is read again) only if the settings change or statedir is emptied.
+
+        :param statedir: Directory holding the per-file counts, created if it does not exist
+        :type statedir: str
+        :param vars: The variables to be cut
+        :type vars: list
+        :param cuts: Cuts to be applied before the FOM is generated
+        :type cuts: str
+        :param isSigvar: name of isSignal variable 
+        :type isSigvar: str
+        :param massvar: Name of primary mass variable
+        :type massvar: str
+        :param signalregion: Signal region of primary mass variable
+        :type signalregion: tuple
+        :param branches: Branches to read from each file, which must include every variable used by cuts (default: 
+                         vars and massvar). isSigvar is always read.
+        :type branches: list
+        :param directions: Values of isGreaterThan to scan for each variable
+        :type directions: tuple
+        :param myrange: The range over which cuts should be applied for each variable
+        :type myrange: dict (key: var, value: tuple)
+        :param nbins: The number of bins 
+        :type nbins: int 
+        :param scale: Factor by which to scale the signal, or name of a column of per-event weights
+        :type scale: Float or str
+        :param bgscale: Factor by which to scale the background, name of a column of per-event weights, or either per file (default 1)
+        :type bgscale: Float, str or dict (key: filename, value: Float or str)
+        :param treename: Name of the tree in each root file
+        :type treename: str
+        :param step_size: If given, stream each tree in chunks of this many entries (int) or bytes (str, e.g. '100 MB')
+        :type step_size: int or str
+
+        :raise TypeError: If statedir is not a str
+        '''
+
+        if isinstance(statedir, str):
+            self.statedir = statedir
+        else:
+            raise TypeError('statedir is not a string.')
+
+        self.vars, self.cuts, self.isSigvar, self.massvar, self.signalregion = list(vars), cuts, isSigvar, massvar, tuple(signalregion)
+        self.directions, self.myrange, self.nbins = tuple(directions), myrange, nbins
+        self.scale, self.bgscale, self.treename, self.step_size = scale, bgscale, treename, step_size
+
+        branches = list(self.vars) + [massvar] if branches is None else list(branches)
+        self.branches = list(dict.fromkeys(branches + [isSigvar]))
+
+        os.makedirs(statedir, exist_ok = True)
+
+    def update(self, mcpath, workers = 1):
+
+        '''Bring the per-file counts in line with the root files in a directory and return the merged scans.
+
+        :param mcpath: Path to the directory containing the MC root files
+        :type mcpath: str
+        :param workers: Number of threads reading new and changed files concurrently
+        :type workers: int
+        :return: Scans in the format of Plotter.scanFoms, and the names of the added, changed and removed files
+        :rtype: tuple (pandas DataFrame, dict (key: 'added', 'changed' or 'removed', value: list))'''
+
+        manifest = self._manifest()
+
+        # Compare the files in the directory with the ones counted so far
+        mcfiles = [mcfile for mcfile in os.listdir(mcpath) if mcfile.endswith('.root')]
+        stats = {mcfile : _file_stat(os.path.join(mcpath, mcfile)) for mcfile in mcfiles}
+        changes = {'added' : [mcfile for mcfile in mcfiles if mcfile not in manifest['files']],
+                   'changed' : [mcfile for mcfile in mcfiles if mcfile in manifest['files'] and manifest['files'][mcfile]['stat'] != stats[mcfile]],
+                   'removed' : [mcfile for mcfile in manifest['files'] if mcfile not in stats]}
+
+        # Drop the counts of removed and changed files
+        for mcfile in changes['removed'] + changes['changed']:
+            os.remove(os.path.join(self.statedir, manifest['files'].pop(mcfile)['counts']))
+
+        # Select the signal and background values of the new and changed files
+        todo = changes['changed'] + changes['added']
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                selections = list(pool.map(lambda mcfile: self._select(mcpath, mcfile), todo))
+        else:
+            selections = [self._select(mcpath, mcfile) for mcfile in todo]
+
+        # The first files counted fix the test cuts
+        if manifest['testcuts'] is None and len(todo) > 0:
+            manifest['testcuts'] = self._test_cuts(selections)
+
+        for mcfile, selection in zip(todo, selections):
+            name = f'{hashlib.sha1(mcfile.encode()).hexdigest()}.npz'
+            self._save(name, self._count(selection, manifest['testcuts']))
+            manifest['files'][mcfile] = {'stat' : stats[mcfile], 'counts' : name}
+
+        self._write_manifest(manifest)
+
+        return self._merge(manifest), changes
+
+    def _settings(self):
+
+        # Everything the counts depend on, so a change of settings starts the state over
+        return json.loads(json.dumps({'vars' : self.vars, 'cuts' : self.cuts, 'isSigvar' : self.isSigvar, 'massvar' : self.massvar, 
+                                      'signalregion' : self.signalregion, 'branches' : self.branches, 'directions' : self.directions, 
+                                      'myrange' : {var : list(self.myrange[var]) for var in self.vars if var in self.myrange}, 
+                                      'nbins' : self.nbins, 'scale' : self.scale, 'bgscale' : self.bgscale, 'treename' : self.treename}))
+
+    def _manifest(self):
+
+        # Manifest of the state: settings, test cuts of each variable and direction, and counted files
+        path = os.path.join(self.statedir, 'manifest.json')
+        if os.path.isfile(path):
+            with open(path) as file:
+                manifest = json.load(file)
+            if manifest['settings'] == self._settings():
+                return manifest
+            for counts in manifest['files'].values():
+                os.remove(os.path.join(self.statedir, counts['counts']))
+
+        return {'settings' : self._settings(), 'testcuts' : None, 'files' : {}}
+
+    def _select(self, mcpath, mcfile):
+
+        # Signal and background values of each variable in the signal region, and their weights, for one file
+        with _stage('read') as stage:
+            df = _load_tree(os.path.join(mcpath, mcfile), self.branches, self.step_size, treename = self.treename)
+            stage.rows_out = len(df)
+
+        srcut = f'{self.signalregion[0]} < {self.massvar} < {self.signalregion[1]}'
+        cache = CutCache()
+        sigmask = cache.mask(df, self.cuts, srcut, f'{self.isSigvar} == 1')
+        bkgmask = cache.mask(df, self.cuts, srcut, f'{self.isSigvar} != 1')
+
+        bgscale = self.bgscale.get(mcfile, 1) if isinstance(self.bgscale, dict) else self.bgscale
+        sigweights, bkgweights = _file_weights(df, sigmask, self.scale), _file_weights(df, bkgmask, bgscale)
+
+        return {'values' : {var : (df[var].to_numpy()[sigmask], df[var].to_numpy()[bkgmask]) for var in self.vars},
+                'weights' : (sigweights, bkgweights), 'total_sig' : float(_sum_weights(numpy.count_nonzero(sigmask), sigweights))}
+
+    def _test_cuts(self, selections):
+
+        # Test cuts of each variable and direction, from myrange or the range of the signal values of all selections
+        testcuts = {}
+        for var in self.vars:
+            np_sig = numpy.concatenate([selection['values'][var][0] for selection in selections])
+            for isGreaterThan in self.directions:
+                testcuts[f'{var}|{isGreaterThan}'] = _test_cuts(np_sig, tuple(self.myrange.get(var, ())), isGreaterThan, self.nbins).tolist()
+        return testcuts
+
+    def _count(self, selection, testcuts):
+
+        # Numbers of signal and background events of one file passing each test cut, and their sums of squared weights
+        sigweights, bkgweights = selection['weights']
+        counts = {'total_sig' : numpy.array(selection['total_sig'])}
+        for var in self.vars:
+            np_sig, np_bkg = selection['values'][var]
+            for isGreaterThan in self.directions:
+                key = f'{var}|{isGreaterThan}'
+                cuts = numpy.array(testcuts[key])
+                with _stage('scan', np_sig.size + np_bkg.size):
+                    counts[f'{key}|globalsig'], counts[f'{key}|sigsumw2'] = _count_passing_weighted(np_sig, cuts, isGreaterThan, sigweights)
+                    counts[f'{key}|globalbkg'], counts[f'{key}|bkgsumw2'] = _count_passing_weighted(np_bkg, cuts, isGreaterThan, bkgweights)
+        return counts
+
+    def _merge(self, manifest):
+
+        # Add up the counts of every file and compute the scans from the sums
+        totals = None
+        for mcfile in manifest['files'].values():
+            with numpy.load(os.path.join(self.statedir, mcfile['counts'])) as counts:
+                totals = {key : counts[key] for key in counts.files} if totals is None else \
+                         {key : totals[key] + counts[key] for key in totals}
+
+        tables = []
+        for var in self.vars:
+            for isGreaterThan in self.directions:
+                key = f'{var}|{isGreaterThan}'
+                testcuts = numpy.array(manifest['testcuts'][key]) if manifest['testcuts'] is not None else numpy.zeros(self.nbins)
+                sums = [totals[f'{key}|{name}'] if totals is not None else numpy.zeros(self.nbins) 
+                        for name in ('globalsig', 'globalbkg', 'sigsumw2', 'bkgsumw2')]
+                total_sig = totals['total_sig'] if totals is not None else 0.0
+                tables.append(_fom_table(var, isGreaterThan, _fom_curves(testcuts, total_sig, *sums)))
+
+        return pd.concat(tables, ignore_index = True)
+
+    def _save(self, name, counts):
+
+        # Write to a temporary file first so a crash never leaves truncated counts behind
+        tmp = os.path.join(self.statedir, f'{name}.tmp')
+        with open(tmp, 'wb') as file:
+            numpy.savez(file, **counts)
+        os.replace(tmp, os.path.join(self.statedir, name))
+
+    def _write_manifest(self, manifest):
+        tmp = os.path.join(self.statedir, 'manifest.json.tmp')
+        with open(tmp, 'w') as file:
+            json.dump(manifest, file)
+        os.replace(tmp, os.path.join(self.statedir, 'manifest.json'))
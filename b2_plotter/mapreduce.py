@@ -0,0 +1,299 @@
+'''
+Map-reduce execution of the stacked histograms and FOM scans of b2_plotter, for samples too big for one process
+or one node. The root files are split into shards of a few files, each shard is turned into a task (a plain dict
+which is JSON serializable), and run_task reads the files of a task, applies its cuts and returns a partial
+result: a dict of numpy arrays (histogram counts, cumulative FOM counts, value ranges or moments) which merge()
+combines with the partial results of the other shards.
+
+Tasks can be run on any concurrent.futures.Executor, e.g. a ProcessPoolExecutor, mpi4py.futures.MPIPoolExecutor
+or dask's Client.get_executor(), or on batch nodes from the command line, with the partial results saved as .npz:
+
+Usage: python3 -m b2_plotter.mapreduce task.json partial.npz
+'''
+
+# Preamble
+import sys
+import json
+import numbers
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+from b2_plotter.helpers import _test_cuts, _count_passing, _fom_curves, _profiled, _stage
+from b2_plotter.Plotter import StreamPlotter, HistResult, _stream_values, _merge_moments, _combine_moments, _draw_fom
+
+
+class MapReducePlotter(StreamPlotter):
+
+    def __init__(self, isSigvar: str, mcfiles: dict, signalfiles, massvar: str, signalregion: tuple,
+                 datafiles = None, executor = None, workers: int = 1, filesPerTask: int = 1, step_size = '100 MB',
+                 treename: str = 'xic_tree'):
+
+        '''
+        Initialize a plotter which computes the same histograms and FOM scans as Plotter.plotMC, plotData
+        and plotFom from root files, by running one task per shard of files on an executor and merging
+        their partial results. Unlike StreamPlotter, the weights are numbers (bgscale may also be a dict of
+        numbers per MC sample). Like it, a dynamic range takes a first pass over the files.
+
+        :param executor: Executor running the tasks. By default, a pool of workers processes is started for each
+                         computation, or the tasks run in this process if workers is 1.
+        :type executor: concurrent.futures.Executor
+        :param workers: Number of processes of the default executor
+        :type workers: int
+        :param filesPerTask: Number of root files read by each task
+        :type filesPerTask: int
+
+        Other parameters are the same as for StreamPlotter.
+
+        :raise TypeError: If any parameters dont match expected type
+        '''
+
+        super().__init__(isSigvar, mcfiles, signalfiles, massvar, signalregion, datafiles = datafiles,
+                         step_size = step_size, treename = treename)
+
+        if not isinstance(workers, int):
+            raise TypeError('workers is not an int.')
+        if not isinstance(filesPerTask, int):
+            raise TypeError('filesPerTask is not an int.')
+
+        self.executor, self.workers, self.filesPerTask = executor, workers, filesPerTask
+
+    @_profiled
+    def histData(self, var, cuts, myrange = (), nbins = 100, scale = 1, bgscale = 1, addBlinding = True):
+
+        '''Compute the MC and data histograms drawn by plotData, with one task per shard of files.
+        Parameters are the same as for Plotter.histData.
+
+        :return: Bin edges, counts and sums of squared weights of each MC component, and data counts
+        :rtype: HistResult
+
+        :raise ValueError: If no data files were provided to the constructor
+        :raise TypeError: If scale or bgscale is not a number, or a dict of numbers for bgscale'''
+
+        if self.datafiles is None:
+            raise ValueError('No datafiles were provided to the constructor.')
+
+        # Fill the MC histograms, keeping the width of the signal for blinding
+        mc, sigma = self._histMC(var, cuts, myrange, nbins, scale, bgscale)
+
+        # Fill the data histograms outside of the signal region if blinding is enabled and mass is being plotted, otherwise fill one
+        if addBlinding and var == self.massvar:
+            datacuts = [[cuts, f'{self.massvar} < {self.signalregion[0] - (3 * sigma)}'],
+                        [cuts, f'{self.massvar} > {self.signalregion[1] + (3 * sigma)}']]
+        else:
+            datacuts = [[cuts]]
+
+        groups = {i : self._tasks('hist', self.datafiles, var, datacut, edges = mc.edges.tolist()) for i, datacut in enumerate(datacuts)}
+        partials = self._run(groups)
+
+        return HistResult(var, mc.edges, mc.counts, mc.sumw2, [partials[i]['counts'] for i in range(len(datacuts))])
+
+    @_profiled
+    def scanFom(self, var, cuts, myrange = (), isGreaterThan = True, nbins = 100, scale = 1, bgscale = 1):
+
+        '''Compute the figure of merit, signal efficiency and purity curves for cuts on a variable, with one
+        task per shard of files counting the events passing every test cut. Parameters and return value are
+        the same as for Plotter.scanFom.
+
+        :raise ValueError: If no signal passes the cuts and no range is given
+        :raise TypeError: If scale or bgscale is not a number, or a dict of numbers for bgscale'''
+
+        weights = self._weights(scale, bgscale)
+        srcut = f'{self.signalregion[0]} < {self.massvar} < {self.signalregion[1]}'
+        sigcuts = [cuts, srcut, f'{self.isSigvar} == 1']
+        bkgcuts = [cuts, srcut, f'{self.isSigvar} != 1']
+
+        # Calculate the dynamic range for the variable from the signal passing the cuts in a first pass, if needed
+        extent = numpy.empty(0)
+        if myrange == ():
+            partial = self._run({'signal' : self._tasks('range', self.signalfiles, var, sigcuts)})['signal']
+            if not numpy.isfinite(partial['min']):
+                raise ValueError('No signal passes the cuts, so the range of the test cuts cannot be derived.')
+            extent = numpy.array([partial['min'], partial['max']])
+        testcuts = _test_cuts(extent, myrange, isGreaterThan, nbins)
+
+        # Count the signal and the background of each sample passing every test cut
+        options = {'testcuts' : testcuts.tolist(), 'isGreaterThan' : isGreaterThan}
+        groups = {label : self._tasks('count', paths, var, bkgcuts, **options) for label, paths in self.mcfiles.items()}
+        groups['signal'] = self._tasks('count', self.signalfiles, var, sigcuts, **options)
+        partials = self._run(groups)
+
+        globalsig, sigsumw2 = partials['signal']['counts'] * scale, partials['signal']['counts'] * scale**2
+        total_sig = partials['signal']['n'] * scale
+        globalbkg, bkgsumw2 = numpy.zeros(nbins), numpy.zeros(nbins)
+        for label in self.mcfiles:
+            weight = weights[label]
+            globalbkg, bkgsumw2 = globalbkg + partials[label]['counts'] * weight, bkgsumw2 + partials[label]['counts'] * weight**2
+
+        return _fom_curves(testcuts, total_sig, globalsig, globalbkg, sigsumw2, bkgsumw2)
+
+    @_profiled
+    def plotFom(self, var, cuts, myrange = (), isGreaterThan = True, nbins = 100, xlabel = '', scale = 1, bgscale = 1):
+
+        '''Plot the figure of merit, signal efficiency and purity curves computed by scanFom. Parameters and
+        return value are the same as for Plotter.plotFom.'''
+
+        scan = self.scanFom(var, cuts, myrange = myrange, isGreaterThan = isGreaterThan, nbins = nbins,
+                            scale = scale, bgscale = bgscale)
+
+        return _draw_fom(scan, var, isGreaterThan, xlabel)
+
+    def _histMC(self, var, cuts, myrange, nbins, scale, bgscale):
+
+        weights = self._weights(scale, bgscale)
+
+        # Cuts of each background sample and of the signal, in the same order as Plotter.plotMC
+        selections = {label : (paths, [cuts, f'{self.isSigvar} != 1']) for label, paths in self.mcfiles.items()}
+        selections['signal'] = (self.signalfiles, [cuts, f'{self.isSigvar} == 1'])
+
+        if myrange == ():
+            # Calculate the dynamic range for the variable in a first pass over the values passing the cuts
+            extents = self._run({label : self._tasks('range', paths, var, selection) for label, (paths, selection) in selections.items()})
+            myrange = (min(extent['min'] for extent in extents.values()), max(extent['max'] for extent in extents.values()))
+
+        # Fill the histograms, with the moments of the signal to get its standard deviation
+        edges = numpy.histogram_bin_edges([], bins = nbins, range = myrange)
+        partials = self._run({label : self._tasks('hist', paths, var, selection, edges = edges.tolist(), moments = label == 'signal')
+                              for label, (paths, selection) in selections.items()})
+
+        counts, sumw2 = {}, {}
+        for label, partial in partials.items():
+            counts[label], sumw2[label] = partial['counts'] * weights[label], partial['counts'] * weights[label]**2
+        n, _, m2 = partials['signal']['moments']
+        sigma = numpy.sqrt(m2 / n) if n > 0 else numpy.nan
+
+        return HistResult(var, edges, counts, sumw2), sigma
+
+    def _weights(self, scale, bgscale):
+
+        # Weight of each background sample and of the signal, checked before any task runs since the partial results
+        # only hold counts, which per-event weights (names of branches, as StreamPlotter takes) cannot be applied to
+        scales = bgscale if isinstance(bgscale, dict) else {label : bgscale for label in self.mcfiles}
+        if not isinstance(scale, numbers.Number):
+            raise TypeError('scale is not a number. Per-event weights are only supported by Plotter and StreamPlotter.')
+        if not isinstance(bgscale, (numbers.Number, dict)) or not all(isinstance(weight, numbers.Number) for weight in scales.values()):
+            raise TypeError('bgscale is not a number or a dict of numbers. Per-event weights are only supported by Plotter and StreamPlotter.')
+        weights = {label : scales.get(label, 1) for label in self.mcfiles}
+        weights['signal'] = scale
+
+        return weights
+
+    def _tasks(self, kind, paths, var, cuts, **options):
+
+        # One task per shard of filesPerTask files (and one reading nothing if there are no files)
+        return [dict(kind = kind, paths = paths[i:i + self.filesPerTask], var = var, cuts = list(cuts), treename = self.treename,
+                     step_size = self.step_size, **options) for i in range(0, max(len(paths), 1), self.filesPerTask)]
+
+    def _run(self, groups):
+
+        # Run the tasks of every group in one go and merge the partial results of each group
+        tasks = [task for group in groups.values() for task in group]
+        with _stage('map', len(tasks)):
+            if self.executor is not None:
+                results = list(self.executor.map(run_task, tasks))
+            elif self.workers > 1:
+                with ProcessPoolExecutor(self.workers) as pool:
+                    results = list(pool.map(run_task, tasks))
+            else:
+                results = [run_task(task) for task in tasks]
+
+        with _stage('reduce', len(results)):
+            merged, start = {}, 0
+            for name, group in groups.items():
+                merged[name] = merge(results[start:start + len(group)])
+                start += len(group)
+
+        return merged
+
+
+def run_task(task):
+
+    '''Read the root files of a task, apply its cuts and compute its partial result.
+
+    :param task: Kind ("range", "hist" or "count"), paths, var, cuts, treename and step_size, and the bin edges
+                 (and whether to compute moments) of a "hist" task, or the testcuts and isGreaterThan of a "count" task
+    :type task: dict
+    :return: For "range", the min and max of the values. For "hist", the counts in each bin, and the (count, mean, sum
+             of squared deviations) moments of the values if asked for. For "count", the number of values n and
+             the numbers passing each test cut, counts.
+    :rtype: dict (key: name, value: numpy array)'''
+
+    partial = _empty(task)
+    for values in _stream_values(task['paths'], task['var'], task['cuts'], task['treename'], task['step_size']):
+        if task['kind'] == 'range':
+            if values.size > 0:
+                partial['min'] = numpy.minimum(partial['min'], numpy.min(values))
+                partial['max'] = numpy.maximum(partial['max'], numpy.max(values))
+        elif task['kind'] == 'hist':
+            partial['counts'] += numpy.histogram(values, bins = numpy.array(task['edges']))[0]
+            if 'moments' in partial:
+                partial['moments'] = numpy.array(_merge_moments(tuple(partial['moments']), values))
+        else:
+            partial['counts'] += _count_passing(values, numpy.array(task['testcuts']), task['isGreaterThan'])
+            partial['n'] += values.size
+
+    return partial
+
+
+def merge(partials):
+
+    '''Combine the partial results of tasks of the same kind: counts are added, ranges widened and moments combined.
+
+    :param partials: Partial results returned by run_task, at least one
+    :type partials: list
+    :return: The combined result
+    :rtype: dict (key: name, value: numpy array)'''
+
+    merged = dict(partials[0])
+    for partial in partials[1:]:
+        for name, value in partial.items():
+            if name == 'min':
+                merged[name] = numpy.minimum(merged[name], value)
+            elif name == 'max':
+                merged[name] = numpy.maximum(merged[name], value)
+            elif name == 'moments':
+                merged[name] = numpy.array(_combine_moments(tuple(merged[name]), tuple(value)))
+            else:
+                merged[name] = merged[name] + value
+
+    return merged
+
+
+def save_partial(partial, path):
+
+    '''Write a partial result to a .npz file.'''
+
+    numpy.savez(path, **partial)
+
+
+def load_partial(path):
+
+    '''Read a partial result written by save_partial.'''
+
+    with numpy.load(path) as file:
+        return {name : file[name] for name in file.files}
+
+
+# Partial result of a task which read no values
+def _empty(task):
+    if task['kind'] == 'range':
+        return {'min' : numpy.array(numpy.inf), 'max' : numpy.array(-numpy.inf)}
+    if task['kind'] == 'hist':
+        partial = {'counts' : numpy.zeros(len(task['edges']) - 1, dtype = numpy.int64)}
+        if task.get('moments', False):
+            partial['moments'] = numpy.zeros(3)
+        return partial
+    return {'counts' : numpy.zeros(len(task['testcuts']), dtype = numpy.int64), 'n' : numpy.array(0)}
+
+
+def main():
+
+    # Run one task saved as JSON, e.g. on a batch node, and save its partial result
+    if len(sys.argv) != 3:
+        sys.exit('Usage: python3 -m b2_plotter.mapreduce task.json partial.npz')
+
+    with open(sys.argv[1]) as file:
+        task = json.load(file)
+    save_partial(run_task(task), sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
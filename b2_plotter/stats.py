@@ -0,0 +1,262 @@
+'''
+Column statistics of b2_plotter. ColumnStats indexes the min, max and number of non-nan values of each chunk of 
+rows of a DataFrame column, so that CutCache only evaluates a clause comparing a column to numbers on the chunks 
+which it cannot decide from them, and gives the range and approximate quantiles of selected values.
+'''
+
+# Preamble
+import re
+import weakref
+import numpy
+from b2_plotter.helpers import _stage
+
+
+class ColumnStats():
+
+    def __init__(self, chunkRows: int = 2**16, nquantiles: int = 32):
+
+        '''
+        Index of per-chunk statistics of DataFrame columns. The rows of a DataFrame are split into chunks 
+        of chunkRows rows, and the min, max and number of non-nan values of each chunk of a column are 
+        computed the first time the column is looked at (quantiles of each chunk, the first time they are 
+        asked for). They let clauses comparing a column to numbers skip the chunks which cannot pass or 
+        must pass, and give the range of selected values without reading the chunks selected in full. 
+        Entries are keyed by the column and the identity of the DataFrame, and dropped when the DataFrame 
+        is garbage collected.
+
+        :param chunkRows: Number of rows in each chunk
+        :type chunkRows: int
+        :param nquantiles: Number of quantiles kept per chunk for approximate quantiles
+        :type nquantiles: int
+
+        :raise TypeError: If chunkRows or nquantiles is not an int
+        '''
+
+        if not isinstance(chunkRows, int):
+            raise TypeError('chunkRows is not an int.')
+        if not isinstance(nquantiles, int):
+            raise TypeError('nquantiles is not an int.')
+        self.chunkRows, self.nquantiles = chunkRows, nquantiles
+
+        # (id(df), len(df), column) : statistics
+        self.entries = {}
+        self._finalizers = {}
+
+    def get(self, df, column):
+
+        '''Return the statistics of a column.
+
+        :param df: Dataframe holding the column
+        :type df: pandas DataFrame
+        :param column: Name of the column
+        :type column: str
+        :return: First row (starts) and number of rows (lengths) of each chunk, and the min, max (ignoring nan, 
+                 nan if all of the chunk is) and number of non-nan values (count) in each chunk
+        :rtype: dict (key: name, value: numpy array)'''
+
+        key = (id(df), len(df), column)
+        if key not in self.entries:
+            values = df[column].to_numpy()
+            starts = numpy.arange(0, len(values), self.chunkRows)
+            with _stage('stats', len(values)):
+                if len(values) == 0:
+                    entry = {'min' : values[:0], 'max' : values[:0], 'count' : numpy.zeros(0, dtype = numpy.int64)}
+                else:
+                    entry = {'min' : numpy.fmin.reduceat(values, starts), 'max' : numpy.fmax.reduceat(values, starts), 
+                             'count' : (numpy.add.reduceat(~numpy.isnan(values), starts) if values.dtype.kind == 'f' 
+                                        else numpy.diff(numpy.append(starts, len(values))))}
+            entry['starts'], entry['lengths'] = starts, numpy.diff(numpy.append(starts, len(values)))
+            self.entries[key] = entry
+
+            # Forget the statistics of df when it is deleted, so a new frame reusing its id never sees them
+            if id(df) not in self._finalizers:
+                self._finalizers[id(df)] = weakref.finalize(df, self._forget, id(df))
+
+        return self.entries[key]
+
+    def extent(self, df, column, mask):
+
+        '''Return the smallest and largest values of a column in the rows selected by mask, reading only 
+        the chunks selected in part. Like numpy.min and numpy.max, any nan makes both nan.
+
+        :param df: Dataframe holding the column
+        :type df: pandas DataFrame
+        :param column: Name of the column
+        :type column: str
+        :param mask: Selected rows
+        :type mask: numpy array of bool
+        :return: Min and max, or inf and -inf if no rows are selected
+        :rtype: numpy array of float'''
+
+        entry = self.get(df, column)
+        extent = numpy.array([numpy.inf, -numpy.inf])
+        if len(mask) == 0:
+            return extent
+
+        # Chunks selected in full are covered by their statistics, the others are read
+        selected = numpy.add.reduceat(mask, entry['starts'])
+        full = selected == entry['lengths']
+        if numpy.any(entry['count'][full] < entry['lengths'][full]):
+            return numpy.array([numpy.nan, numpy.nan])
+        if numpy.any(full):
+            extent = numpy.array([numpy.min(entry['min'][full]), numpy.max(entry['max'][full])], dtype = numpy.float64)
+
+        values = df[column].to_numpy()
+        for chunk in numpy.flatnonzero((selected > 0) & ~full):
+            start = entry['starts'][chunk]
+            chunkvalues = values[start:start + entry['lengths'][chunk]][mask[start:start + entry['lengths'][chunk]]]
+            extent = numpy.array([numpy.minimum(extent[0], numpy.min(chunkvalues)), numpy.maximum(extent[1], numpy.max(chunkvalues))])
+
+        return extent
+
+    def quantile(self, df, column, q):
+
+        '''Return approximate quantiles of the non-nan values of a column, merged from the min, max and 
+        nquantiles evenly spaced quantiles of each chunk.
+
+        :param df: Dataframe holding the column
+        :type df: pandas DataFrame
+        :param column: Name of the column
+        :type column: str
+        :param q: Probabilities, between 0 and 1
+        :type q: float or array of floats
+        :return: Quantiles
+        :rtype: float or numpy array'''
+
+        entry = self.get(df, column)
+        probabilities = numpy.concatenate([[0], (numpy.arange(self.nquantiles) + 0.5) / self.nquantiles, [1]])
+        if 'quantiles' not in entry:
+            # The min, the quantiles and the max of the non-nan values of each chunk
+            values = df[column].to_numpy()
+            with _stage('stats', len(values)):
+                points = []
+                for start, length, count in zip(entry['starts'], entry['lengths'], entry['count']):
+                    if count > 0:
+                        ordered = numpy.sort(values[start:start + length])
+                        points.append(ordered[numpy.minimum((probabilities * count).astype(numpy.intp), count - 1)])
+            entry['quantiles'] = points
+
+        if len(entry['quantiles']) == 0:
+            raise ValueError(f'Column {column} has no values.')
+
+        # Invert the cumulative distribution of the column, summed from the piecewise linear ones of the chunks
+        counts = entry['count'][entry['count'] > 0]
+        grid = numpy.unique(numpy.concatenate(entry['quantiles']).astype(numpy.float64))
+        cumulative = sum(count * numpy.interp(grid, points, probabilities) for points, count in zip(entry['quantiles'], counts))
+        return numpy.interp(numpy.asarray(q) * numpy.sum(counts), cumulative, grid)
+
+    def mask(self, df, clause):
+
+        '''Evaluate one clause on df with DataFrame.eval. If the clause compares a column to numbers 
+        (e.g. "x > 1" or "1 < x <= 2"), the chunks which the statistics of the column show to pass 
+        or fail it in full are filled in without evaluating it.
+
+        :param df: Dataframe the clause is applied to
+        :type df: pandas DataFrame
+        :param clause: Clause in DataFrame.query syntax, without top-level "and"
+        :type clause: str
+        :return: Mask with one entry per row of df
+        :rtype: numpy array of bool'''
+
+        decided = self._decide(df, clause)
+        if decided is None:
+            with _stage('cuts', len(df)) as stage:
+                mask = df.eval(clause).to_numpy(dtype = bool)
+                stage.rows_out = numpy.count_nonzero(mask)
+            return mask
+
+        # Rows of the chunks passing in full are set, the rows of undecided chunks are evaluated in contiguous runs
+        entry, every, undecided = decided
+        mask = numpy.repeat(every, entry['lengths'])
+        runs = numpy.flatnonzero(numpy.diff(numpy.concatenate([[0], undecided.astype(numpy.int8), [0]])))
+        with _stage('cuts', int(numpy.sum(entry['lengths'][undecided]))) as stage:
+            for first, last in zip(runs[::2], runs[1::2]):
+                start, stop = entry['starts'][first], entry['starts'][last - 1] + entry['lengths'][last - 1]
+                mask[start:stop] = df.iloc[start:stop].eval(clause).to_numpy(dtype = bool)
+            stage.rows_out = numpy.count_nonzero(mask)
+
+        return mask
+
+    def clear(self):
+
+        '''Remove every entry.'''
+
+        self.entries.clear()
+
+    def _decide(self, df, clause):
+
+        # Statistics of the column of a clause comparing it to numbers, and which chunks pass in full and which 
+        # are undecided, or None if the clause is of another kind or no chunk can be decided
+        comparisons = _comparisons(clause)
+        if comparisons is None or comparisons[0] not in df.columns or len(df) == 0 or df[comparisons[0]].dtype.kind not in 'biuf':
+            return None
+        entry = self.get(df, comparisons[0])
+
+        # A chunk is decided if it is under both the comparison in the column dtype (numpy) and the exact one 
+        # (numexpr upcasts float32 columns), so the result does not depend on the engine of DataFrame.eval. 
+        # Rows where the column is nan only pass "!=".
+        complete = entry['count'] == entry['lengths']
+        onlyunequal = all(op == '!=' for op, _ in comparisons[1])
+        none, every = numpy.ones(len(complete), dtype = bool), numpy.ones(len(complete), dtype = bool)
+        try:
+            with numpy.errstate(invalid = 'ignore'):
+                for lows, highs in ((entry['min'], entry['max']), (entry['min'].astype(numpy.float64), entry['max'].astype(numpy.float64))):
+                    fails, passes = numpy.zeros(len(complete), dtype = bool), complete | onlyunequal
+                    for op, value in comparisons[1]:
+                        inside = (lows <= value) & (highs >= value)
+                        if op in ('>', '>='):
+                            fails |= ~_OPERATORS[op](highs, value)
+                            passes &= _OPERATORS[op](lows, value)
+                        elif op in ('<', '<='):
+                            fails |= ~_OPERATORS[op](lows, value)
+                            passes &= _OPERATORS[op](highs, value)
+                        elif op == '==':
+                            fails |= ~inside
+                            passes &= (lows == value) & (highs == value)
+                        else:
+                            # nan != value, so only complete chunks can fail in full
+                            fails |= complete & (lows == value) & (highs == value)
+                            passes &= ~inside
+                    none &= fails
+                    every &= passes
+        except (OverflowError, TypeError):
+            return None
+
+        every &= ~none
+        undecided = ~none & ~every
+        if numpy.all(undecided):
+            return None
+        return entry, every, undecided
+
+    def _forget(self, dfid):
+
+        for key in [key for key in self.entries if key[0] == dfid]:
+            del self.entries[key]
+        self._finalizers.pop(dfid, None)
+
+
+# Comparison operators of DataFrame.query, the operator seen from the other side, and the clauses comparing a 
+# column to numbers ("x > 1", "1 < x", "1 < x <= 2")
+_OPERATORS = {'<' : numpy.less, '<=' : numpy.less_equal, '>' : numpy.greater, '>=' : numpy.greater_equal, 
+              '==' : numpy.equal, '!=' : numpy.not_equal}
+_FLIPPED = {'<' : '>', '<=' : '>=', '>' : '<', '>=' : '<=', '==' : '==', '!=' : '!='}
+_NAME, _NUMBER, _OP = r'([A-Za-z_][A-Za-z0-9_]*)', r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)', r'(<=|>=|==|!=|<|>)'
+
+
+# Parse a clause comparing one column to numbers into the column and a list of (operator, number), with the 
+# column on the left of each operator, or None if the clause is of another kind
+def _comparisons(clause):
+
+    def number(text):
+        return int(text) if re.fullmatch(r'[-+]?\d+', text) else float(text)
+
+    match = re.fullmatch(rf'\s*{_NAME}\s*{_OP}\s*{_NUMBER}\s*', clause)
+    if match:
+        return match.group(1), [(match.group(2), number(match.group(3)))]
+    match = re.fullmatch(rf'\s*{_NUMBER}\s*{_OP}\s*{_NAME}\s*', clause)
+    if match:
+        return match.group(3), [(_FLIPPED[match.group(2)], number(match.group(1)))]
+    match = re.fullmatch(rf'\s*{_NUMBER}\s*(<=|>=|<|>)\s*{_NAME}\s*(<=|>=|<|>)\s*{_NUMBER}\s*', clause)
+    if match:
+        return match.group(3), [(_FLIPPED[match.group(2)], number(match.group(1))), (match.group(4), number(match.group(5)))]
+    return None
@@ -0,0 +1,243 @@
+'''
+Column storage of b2_plotter. ColumnCache keeps the branches read from root files as .npy files on disk, so warm 
+starts of construct_dfs memory-map them instead of decompressing the files again. ColumnStore writes the columns 
+of dataframes to shared memory, so worker processes read them as views instead of receiving copies.
+'''
+
+# Preamble
+import os
+import json
+import hashlib
+import weakref
+import numpy
+import pandas as pd
+from b2_plotter.helpers import up, _load_tree
+
+
+class ColumnCache():
+
+    def __init__(self, cachedir: str):
+
+        '''
+        On-disk cache of the branches read from root files, stored as one .npy file per column so that 
+        warm starts memory-map the columns instead of decompressing the root files again. Each root file 
+        and tree gets its own entry, which is wiped automatically when the size or modification time of 
+        the file changes. Requesting a column that is not cached yet only reads and adds that column.
+
+        :param cachedir: Directory holding the cache, created if it does not exist
+        :type cachedir: str
+
+        :raise TypeError: If cachedir is not a str
+        '''
+
+        if isinstance(cachedir, str):
+            self.cachedir = cachedir
+        else:
+            raise TypeError('cachedir is not a string.')
+
+        os.makedirs(cachedir, exist_ok = True)
+
+    def load(self, path, branches, step_size = None, executor = None, treename = 'xic_tree'):
+
+        '''Return a dataframe of the requested branches of a tree, backed by memory-mapped cache files.
+
+        :param path: Path to the root file
+        :type path: str
+        :param branches: Names of the branches to load. Names which are not in the tree are ignored.
+        :type branches: list
+        :param step_size: Chunk size used when reading missing columns from the root file
+        :type step_size: int or str
+        :param executor: Executor used to decompress baskets when reading missing columns
+        :type executor: concurrent.futures.Executor
+        :param treename: Name of the tree in the root file
+        :type treename: str
+        :return: Dataframe with the columns in tree order, as tree.arrays(filter_name = branches) would give
+        :rtype: pandas DataFrame'''
+
+        entry, manifest = self._entry(path, treename)
+
+        # Keep the branches which exist in the tree, in tree order, and read the ones not cached yet
+        columns = [key for key in manifest['keys'] if key in branches]
+        missing = [column for column in columns if column not in manifest['columns']]
+        if len(missing) > 0:
+            df = _load_tree(path, missing, step_size, executor, treename)
+            for column in missing:
+                self._save(entry, column, df[column].to_numpy())
+            manifest['columns'] += missing
+            self._write_manifest(entry, manifest)
+
+        # Memory-map every requested column, which pandas wraps without copying
+        arrays = {column : numpy.load(os.path.join(entry, f'{column}.npy'), mmap_mode = 'r') for column in columns}
+        return pd.DataFrame(arrays, copy = False)
+
+    def _entry(self, path, treename):
+
+        # Directory of the cache entry for this file and tree, and its manifest
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = os.path.join(self.cachedir, hashlib.sha1(f'{path}:{treename}'.encode()).hexdigest())
+        manifestpath = os.path.join(entry, 'manifest.json')
+
+        if os.path.isfile(manifestpath):
+            with open(manifestpath) as file:
+                manifest = json.load(file)
+
+            # Reuse the entry only if the file is unchanged, otherwise start it over
+            if manifest['size'] == stat.st_size and manifest['mtime'] == stat.st_mtime_ns:
+                return entry, manifest
+            for name in os.listdir(entry):
+                os.remove(os.path.join(entry, name))
+
+        # New entry: record the file's size, mtime and branch names
+        os.makedirs(entry, exist_ok = True)
+        with up.open(path) as file:
+            keys = list(file[treename].keys())
+        manifest = {'path' : path, 'treename' : treename, 'size' : stat.st_size, 'mtime' : stat.st_mtime_ns,
+                    'keys' : keys, 'columns' : []}
+        self._write_manifest(entry, manifest)
+
+        return entry, manifest
+
+    def _save(self, entry, column, array):
+
+        # Write to a temporary file first so a crash never leaves a truncated column behind
+        tmp = os.path.join(entry, f'{column}.npy.tmp')
+        with open(tmp, 'wb') as file:
+            numpy.save(file, array)
+        os.replace(tmp, os.path.join(entry, f'{column}.npy'))
+
+    def _write_manifest(self, entry, manifest):
+        tmp = os.path.join(entry, 'manifest.json.tmp')
+        with open(tmp, 'w') as file:
+            json.dump(manifest, file)
+        os.replace(tmp, os.path.join(entry, 'manifest.json'))
+
+
+class ColumnStore():
+
+    def __init__(self, frames: dict, directory: str = None):
+
+        '''
+        Store of the columns of some dataframes in memory-mapped .npy files, by default on the shared memory 
+        filesystem /dev/shm, so that several processes read the same physical pages instead of each holding a 
+        pickled copy of the dataframes. Pickling a store only pickles the path of its directory: a worker 
+        process unpickling it attaches to the same files, and store[name] gives a dataframe of read-only 
+        views of them without copying. The process which created the store removes the files when it is 
+        closed, garbage collected, or when that process exits.
+
+        Only numeric, bool and categorical columns can be stored. The index of the dataframes is not kept.
+
+        :param frames: Dataframes to store (None values are skipped)
+        :type frames: dict (key: name, value: pandas DataFrame)
+        :param directory: New directory to hold the files (default: a temporary directory in /dev/shm, or in 
+                          the default temporary directory if there is no /dev/shm)
+        :type directory: str
+
+        :raise TypeError: If frames is not a dict of dataframes, or a column has an unsupported dtype
+        '''
+
+        import tempfile
+
+        if not isinstance(frames, dict) or not all(df is None or isinstance(df, pd.DataFrame) for df in frames.values()):
+            raise TypeError('frames is not a dictionary of pandas DataFrames.')
+
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix = 'b2_plotter_', dir = '/dev/shm' if os.path.isdir('/dev/shm') else None)
+        else:
+            os.makedirs(directory)
+        self.directory = directory
+
+        # Remove the files when the store is closed or garbage collected, or at exit, but only in this process
+        self._finalizer = weakref.finalize(self, _remove_store, directory, os.getpid())
+
+        try:
+            self.manifest = {}
+            for name, df in frames.items():
+                if df is not None:
+                    self.manifest[str(name)] = self._save(len(self.manifest), df)
+            with open(os.path.join(directory, 'manifest.json'), 'w') as file:
+                json.dump(self.manifest, file)
+        except BaseException:
+            self.close()
+            raise
+
+    def __getitem__(self, name):
+
+        '''Dataframe of read-only views of the stored columns of a frame.
+
+        :param name: Name of the frame
+        :type name: str
+        :return: The frame, with a RangeIndex
+        :rtype: pandas DataFrame'''
+
+        columns = {}
+        for column in self.manifest[name]['columns']:
+            array = numpy.load(os.path.join(self.directory, column['file']), mmap_mode = 'r')
+            if column['categories'] is not None:
+                array = pd.Categorical.from_codes(array, categories = column['categories'])
+            columns[column['name']] = array
+
+        # One block per column, so pandas wraps the maps without consolidating (copying) them
+        return pd.DataFrame(columns, copy = False) if columns else pd.DataFrame(index = pd.RangeIndex(self.manifest[name]['rows']))
+
+    def __contains__(self, name):
+        return name in self.manifest
+
+    def __iter__(self):
+        return iter(self.manifest)
+
+    @property
+    def nbytes(self):
+
+        '''Size of the stored columns in bytes.'''
+
+        return sum(os.path.getsize(os.path.join(self.directory, column['file'])) 
+                   for frame in self.manifest.values() for column in frame['columns'])
+
+    def close(self):
+
+        '''Remove the files of the store, if this process created it. Dataframes already read from the store 
+        stay valid, but no process can attach to it any more.'''
+
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        return {'directory' : self.directory}
+
+    def __setstate__(self, state):
+
+        # Attach to the files of the store without owning them
+        self.directory = state['directory']
+        with open(os.path.join(self.directory, 'manifest.json')) as file:
+            self.manifest = json.load(file)
+        self._finalizer = weakref.finalize(self, _remove_store, self.directory, None)
+
+    def _save(self, index, df):
+
+        columns = []
+        for i, (name, series) in enumerate(df.items()):
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                array, categories = series.cat.codes.to_numpy(), series.cat.categories.tolist()
+            elif series.dtype.kind in 'biuf':
+                array, categories = series.to_numpy(), None
+            else:
+                raise TypeError(f'Column "{name}" of dtype {series.dtype} cannot be stored.')
+
+            file = f'{index}_{i}.npy'
+            numpy.save(os.path.join(self.directory, file), array)
+            columns.append({'name' : name, 'file' : file, 'categories' : categories})
+
+        return {'rows' : len(df), 'columns' : columns}
+
+
+# Remove the directory of a ColumnStore, unless called from another process, e.g. a forked worker
+def _remove_store(directory, pid):
+    import shutil
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors = True)
@@ -0,0 +1,48 @@
+
+# Preamble
+import json
+import numpy
+from b2_plotter.benchmark import generate, generate_samples, run_suite, save_results, compare, SUITE
+from b2_plotter.Plotter import construct_dfs, cols
+
+def test_generate(tmp_path):
+    paths = generate_samples(str(tmp_path), nrows = 20001, samples = ('ccbar', 'mixed'), signal_fraction = 0.2, chunk_rows = 3000)
+    assert paths == [str(tmp_path / 'ccbar.root'), str(tmp_path / 'mixed.root')]
+
+    mcdfs = construct_dfs(str(tmp_path), cols, 'xi03pi_xic')
+    assert sorted(mcdfs) == ['ccbar.root', 'mixed.root']
+    assert sum(len(df) for df in mcdfs.values()) == 20001
+
+    for df in mcdfs.values():
+        assert sorted(df.columns) == sorted(cols + ['xi03pi_xic_isSignal'])
+        assert abs(df['xi03pi_xic_isSignal'].mean() - 0.2) < 0.03
+
+        # The signal peaks in the mass, the background is flat
+        signal = df.query('xi03pi_xic_isSignal == 1')['xi03pi_xic_M']
+        assert abs(signal.mean() - 2.4679) < 0.001
+        assert df.query('xi03pi_xic_isSignal != 1')['xi03pi_xic_M'].between(2.2, 2.7).all()
+
+    # The same seed gives the same file
+    generate(str(tmp_path / 'again.root'), nrows = 10001, signal_fraction = 0.2, seed = 0, chunk_rows = 3000)
+    again = construct_dfs(str(tmp_path), cols, 'xi03pi_xic')['again.root']
+    assert numpy.array_equal(again.to_numpy(), mcdfs['ccbar.root'].to_numpy())
+
+def test_suite(tmp_path):
+    generate_samples(str(tmp_path / 'mc'), nrows = 20000, samples = ('ccbar', 'mixed'))
+    results = run_suite(str(tmp_path / 'mc'), repeat = 1)
+
+    assert results['rows'] == 20000
+    assert list(results['benchmarks']) == SUITE
+    for result in results['benchmarks'].values():
+        assert result['seconds'] > 0 and result['rows_per_second'] > 0 and result['peak_MB'] > 0
+
+    # Results are appended, and compared to the previous ones on the same number of rows
+    path = str(tmp_path / 'results.jsonl')
+    assert save_results(results, path) is None
+    assert save_results(results, path) == json.loads(json.dumps(results))
+
+    slower = json.loads(json.dumps(results))
+    slower['benchmarks']['plotFom']['seconds'] *= 2
+    regressions = compare(results, slower)
+    assert len(regressions) == 1 and regressions[0].startswith('plotFom: seconds')
+    assert compare(results, results) == []
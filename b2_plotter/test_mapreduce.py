@@ -0,0 +1,59 @@
+# Preamble
+import json
+import pytest as pt
+import numpy
+import pandas as pd
+from b2_plotter.benchmark import generate_samples
+from b2_plotter.mapreduce import MapReducePlotter, run_task, merge, save_partial, load_partial
+from b2_plotter.Plotter import Plotter, construct_dfs, cols
+
+def test_mapreduce(tmp_path):
+    mcfiles = {'ccbar' : generate_samples(str(tmp_path / 'ccbar'), nrows = 30000, samples = ('a', 'b', 'c')),
+               'mixed' : generate_samples(str(tmp_path / 'mixed'), nrows = 20000, samples = ('a', 'b'), seed = 1)}
+    datafiles = generate_samples(str(tmp_path / 'data'), nrows = 20000, samples = ('a', 'b'), seed = 2)
+    signalfiles = mcfiles['ccbar'] + mcfiles['mixed']
+
+    def frame(directory):
+        return pd.concat(construct_dfs(str(tmp_path / directory), cols, 'xi03pi_xic').values(), ignore_index = True)
+
+    plotter = Plotter('xi03pi_xic_isSignal', {label : frame(label) for label in mcfiles}, pd.concat([frame('ccbar'), frame('mixed')]),
+                      'xi03pi_xic_M', (2.46, 2.475), datadf = frame('data'))
+    mapreduce = MapReducePlotter('xi03pi_xic_isSignal', mcfiles, signalfiles, 'xi03pi_xic_M', (2.46, 2.475),
+                                 datafiles = datafiles, workers = 2, filesPerTask = 2)
+
+    # Merged partial results match the in-memory computations
+    cuts = 'xi03pi_xi_M > 1.3'
+    for var in ['xi03pi_xic_M', 'xi03pi_xi_significanceOfDistance']:
+        expected, result = plotter.histData(var, cuts, nbins = 40, bgscale = {'mixed' : 2}), mapreduce.histData(var, cuts, nbins = 40, bgscale = {'mixed' : 2})
+        assert numpy.allclose(result.edges, expected.edges)
+        for label in expected.counts:
+            assert numpy.array_equal(result.counts[label], expected.counts[label])
+        for counts, expectedcounts in zip(result.datacounts, expected.datacounts):
+            assert numpy.array_equal(counts, expectedcounts)
+
+        for isGreaterThan in (True, False):
+            expected = plotter.scanFom(var, cuts, isGreaterThan = isGreaterThan, nbins = 30, scale = 0.5)
+            result = mapreduce.scanFom(var, cuts, isGreaterThan = isGreaterThan, nbins = 30, scale = 0.5)
+            for key in expected:
+                assert numpy.allclose(result[key], expected[key], equal_nan = True)
+
+    # Tasks are JSON serializable and their partial results survive a round trip through .npz
+    tasks = mapreduce._tasks('hist', signalfiles, 'xi03pi_xic_M', [cuts], edges = list(numpy.linspace(2.2, 2.7, 11)), moments = True)
+    partials = [run_task(json.loads(json.dumps(task))) for task in tasks]
+    save_partial(partials[0], str(tmp_path / 'partial.npz'))
+    loaded = load_partial(str(tmp_path / 'partial.npz'))
+    assert all(numpy.array_equal(loaded[name], partials[0][name]) for name in partials[0])
+    merged = merge(partials)
+    assert merged['counts'].sum() == merged['moments'][0] == len(plotter.signaldf.query(cuts))
+
+def test_mapreduce_weights(tmp_path):
+    mcfiles = {'mixed' : generate_samples(str(tmp_path / 'mixed'), nrows = 1000, samples = ('a',))}
+    mapreduce = MapReducePlotter('xi03pi_xic_isSignal', mcfiles, mcfiles['mixed'], 'xi03pi_xic_M', (2.46, 2.475))
+
+    # Per-event weights are rejected before any task runs, as the partial results only hold counts
+    with pt.raises(TypeError, match = 'scale is not a number'):
+        mapreduce.scanFom('xi03pi_xic_M', 'xi03pi_xi_M > 1.3', scale = 'xi03pi_xi_M')
+    with pt.raises(TypeError, match = 'bgscale is not a number'):
+        mapreduce.scanFom('xi03pi_xic_M', 'xi03pi_xi_M > 1.3', bgscale = 'xi03pi_xi_M')
+    with pt.raises(TypeError, match = 'bgscale is not a number'):
+        mapreduce.histMC('xi03pi_xic_M', 'xi03pi_xi_M > 1.3', bgscale = {'mixed' : 'xi03pi_xi_M'})
@@ -1,61 +1,399 @@
 
 # Preamble
 import pytest as pt
-from b2_plotter.Plotter import Plotter, parse_cmd, construct_dfs, get_fom
+from b2_plotter.benchmark import generate_samples
+from b2_plotter.Plotter import Plotter, StreamPlotter, CutCache, split_cuts, parse_cmd, construct_dfs, get_fom, render_foms, render_windows, draw_fom_window, HistResult, draw_stack, memory_report, profiling, set_backend, FigureTemplates
+from b2_plotter.incremental import IncrementalScan
+from b2_plotter.stats import ColumnStats
+from b2_plotter.store import ColumnCache, ColumnStore
+from b2_plotter.candidates import BestCandidate
+import b2_plotter.Plotter
 import uproot as up
 import os
+import tempfile
 import argparse as ap
 from unittest.mock import patch
 import pandas as pd
+import numpy
+import mmap
+import pickle
 import matplotlib.pyplot as plt 
 
-# Define a testfile and test columns
-mixed = 'mc/xipipi_miprompt_700fb.root'
-ccbar = 'mc/xipipi_ccprompt_700fb.root'
-
+# Define test columns
 mycols= ['xipipi_xic_M', 'xipipi_xi_significanceOfDistance', 'xipipi_lambda_p_protonID', 'xipipi_xi_M', 'xipipi_xic_isSignal']
 
+# Generate a mixed and a ccbar test file with these columns, in a directory which is removed at exit
+tmpdir = tempfile.TemporaryDirectory()
+mcdir = os.path.join(tmpdir.name, 'mc')
+mixed_path, ccbar_path = generate_samples(mcdir, nrows = 40000, samples = ('xipipi_miprompt_700fb', 'xipipi_ccprompt_700fb'), 
+                                          columns = mycols, isSigvar = 'xipipi_xic_isSignal', massvar = 'xipipi_xic_M')
+
 # Define a test cut
 xicmassrangeloose = '2.3 < xipipi_xic_M < 2.65'
 
 # Create dataframes
-with up.open(mixed) as mixed:
+with up.open(mixed_path) as mixed:
     tree = mixed['xic_tree']
-    df_mixed = tree.arrays(filter_name = mycols + ['xi03pi_xic_isSignal'], library = "pd")
+    df_mixed = tree.arrays(filter_name = mycols, library = "pd")
 
-with up.open(ccbar) as ccbar:
+with up.open(ccbar_path) as ccbar:
     tree = ccbar['xic_tree']
-    df_ccbar = tree.arrays(filter_name = mycols + ['xi03pi_xic_isSignal'], library = "pd")
+    df_ccbar = tree.arrays(filter_name = mycols, library = "pd")
 
-plotter = Plotter(isSigvar = 'xic_isSignal', mcdfs={'mixed': df_mixed}, signaldf = df_ccbar)
+plotter = Plotter(isSigvar = 'xipipi_xic_isSignal', mcdfs = {'mixed': df_mixed}, signaldf = df_ccbar, 
+                  massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475))
 
 # CLASS TESTING
 # -------------
 def test_constructor():
     assert isinstance(plotter, Plotter)
 
+def test_bkgstore():
+    assert len(plotter.bkgdf) == len(df_mixed)
+    assert list(plotter.bkgdf[plotter.samplecol].cat.categories) == ['mixed']
+
+    counts = plotter.histMC('xipipi_xi_M', xicmassrangeloose).counts
+    assert list(counts) == ['mixed', 'signal']
+    assert counts['mixed'].sum() == len(df_mixed.query(f'{xicmassrangeloose} and xipipi_xic_isSignal != 1'))
+
 def test_plot():
     for var in mycols[:-1]:
-        plotter.plot(var, cuts = xicmassrangeloose).savefig(f'plot_{var}.png')
+        plotter.plotMC(var, cuts = xicmassrangeloose, color = ['b', 'r']).savefig(f'plot_{var}.png')
         assert os.path.isfile(f'plot_{var}.png')
 
+def test_histMC():
+    result = plotter.histMC('xipipi_xi_M', cuts = xicmassrangeloose, nbins = 50)
+    assert isinstance(result, HistResult)
+    assert len(result.edges) == 51
+    assert list(result.counts) == ['mixed', 'signal']
+    assert result.counts['signal'].sum() == len(df_ccbar.query(f'{xicmassrangeloose} and xipipi_xic_isSignal == 1'))
+
+    # Asking again, or restyling the plot, reuses the cached result without evaluating any cut
+    misses = plotter.cutcache.misses
+    assert plotter.histMC('xipipi_xi_M', cuts = xicmassrangeloose, nbins = 50) is result
+    plotter.plotMC('xipipi_xi_M', cuts = xicmassrangeloose, nbins = 50, isLog = True, color = ['r', 'b'])
+    plt.close()
+    assert plotter.cutcache.misses == misses
+
+    draw_stack(result, plt.subplot(), xlabel = 'M', color = ['r', 'b']).close()
+
+    # The histogram cache keeps the most recently used histograms within the memory budget
+    small = Plotter(isSigvar = 'xipipi_xic_isSignal', mcdfs = {'mixed': df_mixed}, signaldf = df_ccbar, 
+                    massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475), maxCacheBytes = 2 * result.nbytes)
+    first, second = [small.histMC(var, cuts = xicmassrangeloose, nbins = 50) for var in mycols[:2]]
+    assert small.histMC(mycols[0], cuts = xicmassrangeloose, nbins = 50) is first
+    small.histMC(mycols[2], cuts = xicmassrangeloose, nbins = 50)
+    assert small.histcache.nbytes <= 2 * result.nbytes
+    assert small.histMC(mycols[0], cuts = xicmassrangeloose, nbins = 50) is first
+    assert small.histMC(mycols[1], cuts = xicmassrangeloose, nbins = 50) is not second
+
+def test_weights():
+    weighted_mixed = df_mixed.assign(weight = 0.5)
+    weighted_ccbar = df_ccbar.assign(weight = 2.0)
+    weighted = Plotter(isSigvar = 'xipipi_xic_isSignal', mcdfs = {'mixed': weighted_mixed}, signaldf = weighted_ccbar,
+                       massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475))
+
+    # Per-event weight columns give the same numbers as the equivalent per-sample factors
+    bycolumn = weighted.histMC('xipipi_xi_M', cuts = xicmassrangeloose, scale = 'weight', bgscale = 'weight')
+    bysample = weighted.histMC('xipipi_xi_M', cuts = xicmassrangeloose, scale = 2.0, bgscale = {'mixed': 0.5})
+    for label in bysample.counts:
+        assert numpy.allclose(bycolumn.counts[label], bysample.counts[label])
+        assert numpy.allclose(bycolumn.sumw2[label], bysample.sumw2[label])
+
+    assert numpy.isclose(weighted.getPurity(xicmassrangeloose, scale = 'weight', bgscale = 'weight'),
+                         weighted.getPurity(xicmassrangeloose, scale = 2.0, bgscale = {'mixed': 0.5}))
+
+    scan = weighted.scanFom('xipipi_xi_M', cuts = xicmassrangeloose, scale = 'weight', bgscale = 'weight')
+    assert numpy.allclose(scan['sigsumw2'], scan['globalsig'] * 2.0)
+
+    with pt.raises(TypeError):
+        weighted.getPurity(xicmassrangeloose, bgscale = [0.5])
+
 def test_plotFom():
     for var in mycols[:-1]:
-        fom, cut = plotter.plotFom(var, cuts = xicmassrangeloose, massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475))
+        fom, cut = plotter.plotFom(var, cuts = xicmassrangeloose)
         fom.savefig(f'fom_{var}.png')
         assert os.path.isfile(f'fom_{var}.png')
         assert isinstance(cut, float)
 
+def test_scanFom():
+    for var in mycols[:-1]:
+        for isGreaterThan in (True, False):
+            scan = plotter.scanFom(var, cuts = xicmassrangeloose, isGreaterThan = isGreaterThan, nbins = 20)
+
+            # Compare against one query per test cut
+            op = '>' if isGreaterThan else '<'
+            for i, testcut in enumerate(scan['testcuts']):
+                sr = f'{xicmassrangeloose} and 2.46 < xipipi_xic_M < 2.475 and {var} {op} {testcut}'
+                assert scan['globalsig'][i] == len(df_ccbar.query(f'{sr} and xipipi_xic_isSignal == 1'))
+                assert scan['globalbkg'][i] == len(df_mixed.query(f'{sr} and xipipi_xic_isSignal != 1'))
+
+def test_scanFom_narrow():
+    # Inside the signal region the mass peak is so narrow that the automatic range for var < testcut is reversed
+    var = 'xipipi_xic_M'
+    scan = plotter.scanFom(var, cuts = xicmassrangeloose, isGreaterThan = False, nbins = 20)
+    assert scan['testcuts'][0] > scan['testcuts'][-1]
+
+    for i, testcut in enumerate(scan['testcuts']):
+        sr = f'{xicmassrangeloose} and 2.46 < xipipi_xic_M < 2.475 and {var} < {testcut}'
+        assert scan['globalsig'][i] == len(df_ccbar.query(f'{sr} and xipipi_xic_isSignal == 1'))
+        assert scan['globalbkg'][i] == len(df_mixed.query(f'{sr} and xipipi_xic_isSignal != 1'))
+
+    # The batch and grid scans share the counting
+    table = plotter.scanFoms([var], cuts = xicmassrangeloose, directions = (False,), nbins = 20)
+    assert (table['globalsig'].to_numpy() == scan['globalsig']).all()
+    grid = plotter.scanFomGrid([var, 'xipipi_xi_M'], cuts = xicmassrangeloose, directions = (False, True), nbins = 20)
+    i, j = 3, 5
+    query = f'{xicmassrangeloose} and {plotter._srcut()} and {var} < {grid["testcuts"][0][i]} and xipipi_xi_M > {grid["testcuts"][1][j]}'
+    assert grid['globalsig'][i, j] == len(df_ccbar.query(f'{query} and xipipi_xic_isSignal == 1'))
+    assert grid['globalbkg'][i, j] == len(df_mixed.query(f'{query} and xipipi_xic_isSignal != 1'))
+
+def test_streamplotter():
+    streamer = StreamPlotter(isSigvar = 'xipipi_xic_isSignal', mcfiles = {'mixed': mixed_path}, signalfiles = ccbar_path,
+                             massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475), datafiles = mixed_path, step_size = 1000)
+    for var in mycols[:-1]:
+        streamer.plotMC(var, cuts = xicmassrangeloose, myrange = (0, 5), color = ['b', 'r']).savefig(f'streammc_{var}.png')
+        assert os.path.isfile(f'streammc_{var}.png')
+        plt.close()
+
+        streamer.plotData(var, cuts = xicmassrangeloose, color = ['b', 'r']).savefig(f'streamdata_{var}.png')
+        assert os.path.isfile(f'streamdata_{var}.png')
+        plt.close()
+
+    # Numbers, per-sample factors and per-event weight branches give the same histograms as Plotter
+    for scale, bgscale in ((2.0, {'mixed': 0.5}), ('xipipi_lambda_p_protonID', {'mixed': 'xipipi_lambda_p_protonID'}), 
+                           ('xipipi_lambda_p_protonID', 0.5)):
+        streamed = streamer.histMC('xipipi_xi_M', cuts = xicmassrangeloose, myrange = (1.3, 1.35), nbins = 20, scale = scale, bgscale = bgscale)
+        expected = plotter.histMC('xipipi_xi_M', cuts = xicmassrangeloose, myrange = (1.3, 1.35), nbins = 20, scale = scale, bgscale = bgscale)
+        for label in expected.counts:
+            assert numpy.allclose(streamed.counts[label], expected.counts[label])
+            assert numpy.allclose(streamed.sumw2[label], expected.sumw2[label])
+
+    with pt.raises(TypeError):
+        streamer.histMC('xipipi_xi_M', cuts = xicmassrangeloose, bgscale = [0.5])
+
+def test_scanFoms():
+    table = plotter.scanFoms(mycols[:-1], cuts = xicmassrangeloose, nbins = 20)
+    assert len(table) == len(mycols[:-1]) * 2 * 20
+
+    for var in mycols[:-1]:
+        for isGreaterThan in (True, False):
+            curve = table[(table['variable'] == var) & (table['isGreaterThan'] == isGreaterThan)]
+            scan = plotter.scanFom(var, cuts = xicmassrangeloose, isGreaterThan = isGreaterThan, nbins = 20)
+            assert (curve['globalsig'].to_numpy() == scan['globalsig']).all()
+            assert (curve['globalbkg'].to_numpy() == scan['globalbkg']).all()
+            assert curve['optimal'].sum() == 1
+            assert curve[curve['optimal']]['testcut'].iloc[0] == plotter.plotFom(var, cuts = xicmassrangeloose, isGreaterThan = isGreaterThan, nbins = 20)[1]
+            plt.close()
+
+    # Empty test cuts give a nan FOM, which is never flagged as optimal
+    myrange = {'xipipi_xi_M' : (0, 2)}
+    curve = plotter.scanFoms(['xipipi_xi_M'], cuts = xicmassrangeloose, directions = (False,), myrange = myrange, nbins = 20)
+    assert curve['fom'].isna().any()
+    assert curve[curve['optimal']]['fom'].iloc[0] == curve['fom'].max()
+    assert curve[curve['optimal']]['testcut'].iloc[0] == plotter.plotFom('xipipi_xi_M', cuts = xicmassrangeloose, myrange = (0, 2), isGreaterThan = False, nbins = 20)[1]
+    plt.close()
+
+def test_preview():
+    full = plotter.histMC('xipipi_xi_M', cuts = xicmassrangeloose, nbins = 20)
+
+    report = plotter.setPreview(0.2, seed = 1)
+    assert (report['kept'] <= report['rows']).all()
+    preview = plotter.histMC('xipipi_xi_M', cuts = xicmassrangeloose, nbins = 20)
+    assert len(plotter.bkgdf) < len(df_mixed)
+
+    # Counts are scaled back up, within a few standard deviations of the full sample
+    for label in full.counts:
+        assert abs(preview.counts[label].sum() - full.counts[label].sum()) < 5 * numpy.sqrt(preview.sumw2[label].sum())
+    assert 'fomerr' in plotter.scanFom('xipipi_xi_M', cuts = xicmassrangeloose)
+
+    # Switching preview off gives back the exact (cached) result
+    plotter.setPreview(None)
+    assert plotter.histMC('xipipi_xi_M', cuts = xicmassrangeloose, nbins = 20) is full
+
+    with pt.raises(ValueError):
+        plotter.setPreview(0)
+
+def test_backends():
+    cuts = f'{xicmassrangeloose} and xipipi_xi_M > 1.3'
+    results = {}
+    for backend in ('numpy', 'numba'):
+        if backend == 'numba':
+            pt.importorskip('numba')
+        assert set_backend(backend) == backend
+        plotter.clearCache()
+        results[backend] = plotter.histMC('xipipi_xi_M', cuts = cuts, nbins = 20, bgscale = 'xipipi_xic_M')
+    set_backend()
+
+    # The fused kernel counts the same rows as a query, and both backends agree exactly
+    counts = results['numpy'].counts
+    assert counts['signal'].sum() == len(df_ccbar.query(f'{cuts} and xipipi_xic_isSignal == 1'))
+    for label in counts:
+        assert numpy.array_equal(results['numba'].counts[label], counts[label])
+        assert numpy.array_equal(results['numba'].sumw2[label], results['numpy'].sumw2[label])
+
+    with pt.raises(ValueError):
+        set_backend('cuda')
+
+def test_scanFomGrid():
+    vars = ['xipipi_xi_significanceOfDistance', 'xipipi_lambda_p_protonID']
+    grid = plotter.scanFomGrid(vars, cuts = xicmassrangeloose, directions = (True, False), nbins = 20)
+    assert grid['fom'].shape == (20, 20)
+
+    # Every cell counts the same events as the corresponding query
+    i, j = 7, 12
+    query = f'{xicmassrangeloose} and {plotter._srcut()} and {vars[0]} > {grid["testcuts"][0][i]} and {vars[1]} < {grid["testcuts"][1][j]}'
+    assert grid['globalsig'][i, j] == len(df_ccbar.query(f'{query} and xipipi_xic_isSignal == 1'))
+    assert grid['globalbkg'][i, j] == len(df_mixed.query(f'{query} and xipipi_xic_isSignal != 1'))
+    assert numpy.nanmax(grid['fom']) == grid['fom'][tuple(list(cuts).index(grid['optimal'][var]) for var, cuts in zip(vars, grid['testcuts']))]
+
+    # A single variable reproduces scanFom
+    scan = plotter.scanFom(vars[0], cuts = xicmassrangeloose, nbins = 20)
+    assert numpy.allclose(plotter.scanFomGrid(vars[:1], cuts = xicmassrangeloose, nbins = 20)['fom'], scan['fom'], equal_nan = True)
+
+    fig, optimal = plotter.plotFomGrid(vars[0], vars[1], cuts = xicmassrangeloose, directions = (True, False))
+    assert list(optimal) == vars
+    fig.savefig('fomgrid.png')
+    plt.close()
+
+def test_render_foms(tmp_path):
+    table = plotter.scanFoms(mycols[:-1], cuts = xicmassrangeloose, nbins = 20)
+    paths = render_foms(table, outdir = str(tmp_path), workers = 2)
+
+    assert paths == [str(tmp_path / f'{var}_{direction}fom.png') for var in mycols[:-1] for direction in ('greater', 'less')]
+    for path in paths:
+        assert os.path.isfile(path)
+
+def test_cutFlow():
+    cuts = [xicmassrangeloose, 'xipipi_xi_significanceOfDistance > 0.5', 'xipipi_xi_M > 1.3 and xipipi_lambda_p_protonID > 0.1']
+    table = plotter.cutFlow(cuts)
+    assert list(table['cut']) == [''] + cuts
+
+    # Each row matches getPurity and getSigEff with all of the cuts so far
+    for i in range(len(table)):
+        assert numpy.isclose(table['purity'][i], plotter.getPurity(' and '.join(cuts[:i])))
+        assert numpy.isclose(table['sigeff'][i], plotter.getSigEff(' and '.join(cuts[:i])))
+    assert (table['bkg_mixed'] == table['globalbkg']).all()
+    assert (numpy.diff(table['globalsig']) <= 0).all()
+
+    with pt.raises(TypeError):
+        plotter.cutFlow(xicmassrangeloose)
+
+def test_scanWindow(tmp_path):
+    scan = plotter.scanWindow('xipipi_xi_M', xicmassrangeloose, nbins = 20)
+    testcuts = scan['testcuts']
+
+    # Each window matches getPurity with both bounds as cuts, and only windows with low < high are filled
+    for i, j in [(0, 20), (3, 12), (7, 8)]:
+        window = f'{xicmassrangeloose} and xipipi_xi_M > {testcuts[i]} and xipipi_xi_M < {testcuts[j]}'
+        assert numpy.isclose(scan['purity'][i, j] * 100, plotter.getPurity(window))
+    assert numpy.isnan(scan['fom'][numpy.tril_indices(len(testcuts))]).all()
+
+    i, j = numpy.unravel_index(numpy.nanargmax(scan['fom']), scan['fom'].shape)
+    assert scan['optimal'] == (testcuts[i], testcuts[j])
+
+    # Drawing and saving the surfaces are profiled like the FOM curves
+    with profiling() as profile:
+        draw_fom_window(scan)
+        plt.close()
+        paths = render_windows({'xipipi_xi_M' : scan}, outdir = str(tmp_path))
+    assert os.path.isfile(paths[0])
+    assert 'draw_fom_window' in profile.stats and 'render_windows' in profile.stats
+
+def test_templates():
+    templates = plotter.setTemplates()
+    plt.close('all')
+    try:
+        # Each kind of plot builds its figure once and redraws it for every variable, without pyplot
+        figures = [plotter.plotMC(var, cuts = xicmassrangeloose) for var in mycols[:2]]
+        assert figures[0] is figures[1] and plt.get_fignums() == []
+        assert figures[1].axes[0].get_xlabel() == mycols[1]
+        assert figures[1].axes[0].get_xlim() == tuple(plotter.histMC(mycols[1], xicmassrangeloose).edges[[0, -1]])
+
+        fom, cut = plotter.plotFom(mycols[0], cuts = xicmassrangeloose)
+        scan = plotter.scanFom(mycols[0], xicmassrangeloose)
+        assert cut == scan['testcuts'][numpy.argmax(scan['fom'])]
+        assert plotter.plotStep(mycols[0], cuts = xicmassrangeloose) is not fom
+        assert len(templates.layouts) == 3
+    finally:
+        plotter.setTemplates(None)
+
+    with pt.raises(TypeError):
+        plotter.setTemplates('yes')
+
 def test_plotStep():
     for var in mycols[:-1]:
         plotter.plotStep(var, cuts = xicmassrangeloose).savefig(f'step_{var}.png')
         assert os.path.isfile(f'step_{var}.png')
 
 def test_getpurity():
-    assert isinstance(plotter.get_purity(xicmassrangeloose, 'xipipi_xic_M', (2.46, 2.475)), float)
+    assert isinstance(plotter.getPurity(xicmassrangeloose), float)
 
 def test_getsigeff():
-    assert isinstance(plotter.get_sigeff(xicmassrangeloose, 'xipipi_xic_M', (2.46, 2.475)), float)
+    assert isinstance(plotter.getSigEff(xicmassrangeloose), float)
+
+def test_profiling(tmp_path):
+    plotter.clearCache()
+    with profiling() as profile:
+        plotter.plotFom('xipipi_xi_M', cuts = xicmassrangeloose)
+        plt.close()
+
+    # The column statistics of the cut variables are computed first, to decide which cut clauses to evaluate
+    assert list(profile.stats) == ['plotFom/scanFom/stats', 'plotFom/scanFom/cuts', 'plotFom/scanFom/scan', 'plotFom/scanFom', 
+                                   'plotFom/draw_fom', 'plotFom']
+    cuts = profile.stats['plotFom/scanFom/cuts']
+    assert cuts['rows_out'] <= cuts['rows_in']
+    assert profile.stats['plotFom']['seconds'] >= profile.stats['plotFom/scanFom']['seconds']
+    assert profile.stats['plotFom']['bytes'] > 0
+
+    profile.save(str(tmp_path / 'profile.json'))
+    assert 'plotFom/draw_fom' in profile.summary()
+
+    # Nothing is recorded outside of the block
+    plotter.getPurity(xicmassrangeloose)
+    assert 'getPurity' not in profile.stats
+
+def test_cutcache():
+    cache = CutCache()
+    mask = cache.mask(df_mixed, xicmassrangeloose, 'xipipi_xi_M > 1.3')
+    assert (mask == df_mixed.eval(f'{xicmassrangeloose} and xipipi_xi_M > 1.3').to_numpy()).all()
+
+    # The same cut again, or a compound cut made of cached clauses, does not evaluate anything new
+    misses = cache.misses
+    cache.mask(df_mixed, f'{xicmassrangeloose} and xipipi_xi_M > 1.3')
+    cache.mask(df_mixed, xicmassrangeloose)
+    assert cache.misses == misses
+
+    # Masks are evicted once the memory budget is exceeded
+    small = CutCache(maxbytes = len(df_mixed))
+    small.mask(df_mixed, xicmassrangeloose)
+    small.mask(df_mixed, 'xipipi_xi_M > 1.3')
+    assert small.nbytes <= len(df_mixed)
+    assert len(small.masks) == 1
+
+def test_columnstats():
+    sortedmixed = df_mixed.sort_values('xipipi_xic_M', ignore_index = True)
+    stats = ColumnStats(chunkRows = 1000)
+    entry = stats.get(sortedmixed, 'xipipi_xic_M')
+    assert entry['count'].sum() == sortedmixed['xipipi_xic_M'].count()
+    assert entry['min'][0] == sortedmixed['xipipi_xic_M'].min() and entry['max'][-1] == sortedmixed['xipipi_xic_M'].max()
+
+    # Chunks decided by the statistics are skipped, and the mask is the same as with DataFrame.eval
+    for clause in [xicmassrangeloose, 'xipipi_xic_M > 2.5', 'xipipi_xic_M != 2.4', 'xipipi_xi_M > 1.3']:
+        assert (stats.mask(sortedmixed, clause) == sortedmixed.eval(clause).to_numpy()).all()
+    assert stats._decide(sortedmixed, 'xipipi_xic_M > 2.5')[2].sum() <= 1
+    assert stats._decide(sortedmixed, 'xipipi_xic_M > xipipi_xi_M') is None
+
+    # Extents of selected values and approximate quantiles
+    mask = sortedmixed.eval('xipipi_xi_M > 1.3').to_numpy()
+    values = sortedmixed['xipipi_xic_M'].to_numpy()[mask]
+    assert (stats.extent(sortedmixed, 'xipipi_xic_M', mask) == [values.min(), values.max()]).all()
+    median = stats.quantile(sortedmixed, 'xipipi_xic_M', 0.5)
+    assert abs(numpy.mean(sortedmixed['xipipi_xic_M'] < median) - 0.5) < 0.01
+
+def test_split_cuts():
+    assert split_cuts('a < 1 and (b > 2 and c < 3) and band > 4') == ['a < 1', '(b > 2 and c < 3)', 'band > 4']
+    assert split_cuts('') == []
 
 def test_errors():
     with pt.raises(TypeError):
@@ -82,10 +420,10 @@ def test_errors():
 def test_parse_cmd():
 
     # Use argparse.Namespace to simulate the parsed command line arguments
-    parsed_args = ap.Namespace(input = 'path/to/MC', prefix = 'xic_prefix_name')
+    parsed_args = ap.Namespace(input = 'path/to/MC', prefix = 'xic_prefix_name', window = False, statedir = None, best = None)
 
     # Patch the argparse.ArgumentParser to return the simulated parsed_args
-    with patch('ap.ArgumentParser.parse_args', return_value = parsed_args):
+    with patch('argparse.ArgumentParser.parse_args', return_value = parsed_args):
         result = parse_cmd()
 
     # Check if the returned result matches the expected result
@@ -93,18 +431,197 @@ def test_parse_cmd():
 
 def test_construct_dfs():
 
-    mcdfs = construct_dfs('mc/', mycols = mycols, prefix = 'xipipi_xic')
+    mcdfs = construct_dfs(mcdir, mycols = mycols, prefix = 'xipipi_xic')
 
     assert isinstance(mcdfs, dict)
-    for df in mcdfs:
+    for df in mcdfs.values():
         assert isinstance(df, pd.DataFrame)
 
+def test_construct_dfs_compact():
+    full = construct_dfs(mcdir, mycols = mycols, prefix = 'xipipi_xic')
+    compact = construct_dfs(mcdir, mycols = mycols, prefix = 'xipipi_xic', dtypes = 'compact')
+
+    for label, df in compact.items():
+        assert df['xipipi_xic_isSignal'].dtype == numpy.int8
+        assert df['xipipi_xic_M'].dtype == numpy.float32
+        assert (df['xipipi_xic_isSignal'].to_numpy() == full[label]['xipipi_xic_isSignal'].to_numpy()).all()
+
+    # Explicit policies: first matching pattern wins
+    custom = construct_dfs(mcdir, mycols = mycols, prefix = 'xipipi_xic', dtypes = {'*_isSignal' : 'bool', 'xipipi_xic_M' : 'float64', '*' : 'float32'})
+    for df in custom.values():
+        assert df['xipipi_xic_isSignal'].dtype == bool
+        assert df['xipipi_xic_M'].dtype == numpy.float64
+
+    # The memory report has one row per sample and a total
+    full_report, compact_report = memory_report(full), memory_report(compact)
+    assert list(compact_report.index) == list(compact) + ['total']
+    assert compact_report.loc['total', 'MB'] < full_report.loc['total', 'MB']
+
+def test_incremental(tmp_path):
+    from b2_plotter.benchmark import generate
+    vars, mcpath, statedir = mycols[1:4], str(tmp_path / 'mc'), str(tmp_path / 'state')
+    os.makedirs(mcpath)
+    for i in range(3):
+        generate(os.path.join(mcpath, f'sample{i}.root'), nrows = 10000, columns = vars, isSigvar = 'xipipi_xic_isSignal', 
+                 massvar = 'xipipi_xic_M', seed = i)
+
+    def scan():
+        return IncrementalScan(statedir, vars, xicmassrangeloose, 'xipipi_xic_isSignal', 'xipipi_xic_M', (2.46, 2.475), nbins = 20)
+
+    def plotter():
+        mcdfs = construct_dfs(mcpath, mycols = vars + ['xipipi_xic_M'], prefix = 'xipipi_xic')
+        return Plotter('xipipi_xic_isSignal', mcdfs, pd.concat(mcdfs.values()), 'xipipi_xic_M', (2.46, 2.475))
+
+    table, changes = scan().update(mcpath)
+    assert sorted(changes['added']) == ['sample0.root', 'sample1.root', 'sample2.root']
+    pd.testing.assert_frame_equal(table, plotter().scanFoms(vars, xicmassrangeloose, nbins = 20), check_dtype = False)
+
+    # Add, rewrite and remove files: only the new and rewritten ones are read
+    generate(os.path.join(mcpath, 'sample3.root'), nrows = 10000, columns = vars, isSigvar = 'xipipi_xic_isSignal', massvar = 'xipipi_xic_M', seed = 3)
+    generate(os.path.join(mcpath, 'sample1.root'), nrows = 5000, columns = vars, isSigvar = 'xipipi_xic_isSignal', massvar = 'xipipi_xic_M', seed = 4)
+    os.remove(os.path.join(mcpath, 'sample0.root'))
+
+    table, changes = scan().update(mcpath)
+    assert changes == {'added' : ['sample3.root'], 'changed' : ['sample1.root'], 'removed' : ['sample0.root']}
+
+    # The test cuts stay those of the first update, and the counts are those of a full scan with the same test cuts
+    full = plotter()
+    for (var, isGreaterThan), curve in table.groupby(['variable', 'isGreaterThan'], sort = False):
+        testcuts = curve['testcut'].to_numpy()
+        expected = full.scanFom(var, xicmassrangeloose, myrange = (testcuts[0], testcuts[0] + (testcuts[1] - testcuts[0]) * 20), 
+                                isGreaterThan = isGreaterThan, nbins = 20)
+        for column, key in (('testcut', 'testcuts'), ('globalsig', 'globalsig'), ('globalbkg', 'globalbkg'), ('fom', 'fom')):
+            assert numpy.allclose(curve[column], expected[key], equal_nan = True)
+
+    assert scan().update(mcpath)[1] == {'added' : [], 'changed' : [], 'removed' : []}
+
+def test_construct_dfs_parallel():
+
+    mcdfs = construct_dfs(mcdir, mycols = mycols, prefix = 'xipipi_xic')
+    parallel = construct_dfs(mcdir, mycols = mycols, prefix = 'xipipi_xic', workers = 4, step_size = 1000)
+
+    assert list(parallel) == list(mcdfs)
+    for label, df in mcdfs.items():
+        assert parallel[label].equals(df)
+
+    concatenated = construct_dfs(mcdir, mycols = mycols, prefix = 'xipipi_xic', workers = 2, concat = True)
+    assert len(concatenated) == sum(len(df) for df in mcdfs.values())
+    assert list(concatenated['sample'].cat.categories) == list(mcdfs)
+
+def test_construct_dfs_cache(tmp_path):
+
+    mcdfs = construct_dfs(mcdir, mycols = mycols, prefix = 'xipipi_xic')
+
+    # Cold start with a subset of the columns, then add the rest
+    construct_dfs(mcdir, mycols = mycols[:2], prefix = 'xipipi_xic', cachedir = str(tmp_path))
+    cached = construct_dfs(mcdir, mycols = mycols, prefix = 'xipipi_xic', cachedir = str(tmp_path))
+    for label, df in mcdfs.items():
+        assert cached[label].equals(df)
+
+    # Warm starts memory-map the cached columns
+    array = ColumnCache(str(tmp_path)).load(mixed_path, mycols)[mycols[0]].to_numpy()
+    while array is not None and not isinstance(array, mmap.mmap):
+        array = getattr(array, 'base', None)
+    assert isinstance(array, mmap.mmap)
+
+def test_signal_from_store(tmp_path):
+
+    # Without a signal frame, the signal is every MC sample, read from the background store
+    both = Plotter(isSigvar = 'xipipi_xic_isSignal', mcdfs = {'mixed': df_mixed, 'ccbar': df_ccbar}, signaldf = None, 
+                   massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475))
+    concat = Plotter(isSigvar = 'xipipi_xic_isSignal', mcdfs = {'mixed': df_mixed, 'ccbar': df_ccbar}, 
+                     signaldf = pd.concat([df_mixed, df_ccbar]), massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475))
+    assert both.signaldf is both.bkgdf
+    assert numpy.array_equal(both.histMC(mycols[0], xicmassrangeloose).counts['signal'], 
+                             concat.histMC(mycols[0], xicmassrangeloose).counts['signal'])
+
+    # The samples are slices of the background store rather than a second copy
+    assert list(both.mcdfs) == ['mixed', 'ccbar']
+    assert both.mcdfs['ccbar'].reset_index(drop = True).equals(df_ccbar)
+    assert numpy.shares_memory(both.mcdfs['ccbar'][mycols[0]].to_numpy(), both.bkgdf[mycols[0]].to_numpy())
+
+    # The store holds the background once, and the shared plotter reads its signal from it
+    store = both.toStore(str(tmp_path / 'store'))
+    assert 'signal' not in store
+    shared = Plotter.fromStore(store, isSigvar = 'xipipi_xic_isSignal', massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475))
+    assert shared.signaldf is shared.bkgdf
+    assert shared.getPurity(xicmassrangeloose) == both.getPurity(xicmassrangeloose)
+    store.close()
+
+def test_column_store(tmp_path):
+
+    store = plotter.toStore(str(tmp_path / 'store'))
+    shared = Plotter.fromStore(store, isSigvar = 'xipipi_xic_isSignal', massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475))
+
+    # The shared plotter reads memory-mapped columns and gives the same results
+    array = shared.bkgdf[mycols[0]].to_numpy()
+    while array is not None and not isinstance(array, mmap.mmap):
+        array = getattr(array, 'base', None)
+    assert isinstance(array, mmap.mmap)
+    assert list(shared.mcdfs) == list(plotter.mcdfs)
+    assert shared.getPurity(xicmassrangeloose) == plotter.getPurity(xicmassrangeloose)
+
+    # It pickles by reference to the store, and the store is removed when closed
+    attached = pickle.loads(pickle.dumps(shared))
+    assert attached.store.directory == store.directory and len(pickle.dumps(shared)) < 1000
+    assert numpy.array_equal(attached.histMC(mycols[0], xicmassrangeloose).counts['signal'], 
+                             plotter.histMC(mycols[0], xicmassrangeloose).counts['signal'])
+    store.close()
+    assert not os.path.isdir(store.directory)
+
+    with pt.raises(TypeError):
+        ColumnStore({'df' : pd.DataFrame({'name' : ['a', 'b']})}, str(tmp_path / 'strings'))
+
+def test_construct_dfs_best(tmp_path):
+
+    # Write the test samples again with event numbers, grouping consecutive candidates into events of one to three
+    keys = ['__experiment__', '__run__', '__event__']
+    mcpath, rng = str(tmp_path / 'mc'), numpy.random.default_rng(0)
+    os.makedirs(mcpath)
+    for path, df in ((mixed_path, df_mixed), (ccbar_path, df_ccbar)):
+        event = numpy.repeat(numpy.arange(len(df)), rng.integers(1, 4, len(df)))[:len(df)]
+        with up.recreate(os.path.join(mcpath, os.path.basename(path))) as file:
+            file['xic_tree'] = {**{col : df[col].to_numpy() for col in mycols}, '__experiment__' : numpy.full(len(df), 26, dtype = numpy.int32), 
+                                '__run__' : (event // 1000).astype(numpy.int32), '__event__' : event.astype(numpy.uint32)}
+    mixed = os.path.basename(mixed_path)
+
+    mcdfs = construct_dfs(mcpath, mycols = mycols + keys, prefix = 'xipipi_xic')
+
+    # Streaming chunk by chunk keeps the same candidates as groupby().idxmax() on the whole file
+    best = BestCandidate('xipipi_xic_M', keys = keys)
+    selected = construct_dfs(mcpath, mycols = mycols, prefix = 'xipipi_xic', step_size = 1000, best = best)
+    for label, df in mcdfs.items():
+        rows = numpy.sort(df.reset_index(drop = True).groupby(keys)['xipipi_xic_M'].idxmax().to_numpy())
+        assert selected[label][mycols].equals(df[mycols].iloc[rows].reset_index(drop = True))
+        assert selected[label]['__multiplicity__'].sum() == len(df)
+
+    report = best.report()
+    assert list(report.index) == list(mcdfs)
+    assert (report['candidates'] == [len(df) for df in mcdfs.values()]).all()
+    assert (report['events'] == [len(df) for df in selected.values()]).all()
+
+    # Selecting again keeps the multiplicities
+    again = BestCandidate('xipipi_xic_M', keys = keys)
+    shared = Plotter(isSigvar = 'xipipi_xic_isSignal', mcdfs = selected, signaldf = selected[mixed], 
+                     massvar = 'xipipi_xic_M', signalregion = (2.46, 2.475), best = again)
+    assert shared.bkgdf['__multiplicity__'].sum() == sum(len(df) for df in mcdfs.values())
+    assert again.report().loc['signal', 'candidates'] == report.loc[mixed, 'candidates']
+
+def test_reexports():
+
+    # Plotter still exports the classes which moved to their own modules
+    assert b2_plotter.Plotter.IncrementalScan is IncrementalScan
+    assert b2_plotter.Plotter.ColumnStats is ColumnStats
+    assert b2_plotter.Plotter.ColumnCache is ColumnCache
+    assert b2_plotter.Plotter.ColumnStore is ColumnStore
+    assert b2_plotter.Plotter.BestCandidate is BestCandidate
+
 def test_get_fom():
 
-    lessfom, lesscut, greaterfom, greatercut = get_fom(cuts = xicmassrangeloose, var = 'xipipi_xi_significanceOfDistance', prefix = 'xipipi_xic', plotter = plotter)
+    (lessfom, lesscut), (greaterfom, greatercut) = get_fom(cuts = xicmassrangeloose, var = 'xipipi_xi_significanceOfDistance', prefix = 'xipipi_xic', plotter = plotter)
 
-    assert isinstance(lessfom, plt.Figure)
-    assert isinstance(greaterfom, plt.Figure)
+    assert isinstance(lessfom.gcf(), plt.Figure)
+    assert isinstance(greaterfom.gcf(), plt.Figure)
 
     assert isinstance(lesscut, float)
     assert isinstance(greatercut, float)
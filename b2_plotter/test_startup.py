@@ -0,0 +1,10 @@
+
+# Preamble
+from b2_plotter.benchmark import import_time, STARTUP_BUDGET
+
+def test_startup():
+    seconds, loaded = import_time()
+
+    # The compute-only entry point must not import matplotlib or uproot, and must stay within the budget on top of numpy and pandas
+    assert loaded == []
+    assert seconds <= STARTUP_BUDGET